@@ -1,12 +1,19 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
-import pandas as pd
-from autogluon.tabular import TabularPredictor
-import os
 import datetime
+import os
+import threading
+import time
 
 # 导入我们自定义的模块
 from ml.aqi import get_aqi_category
+from ml.storage import ARROW_PATH, CSV_PATH, FORECAST_PATH
+from backend import metrics
+from backend.forecast_store import ForecastStore
+from backend.model_registry import ModelRegistry, load_registry_config
+from backend.prediction_cache import PredictionCache
+from backend.profiler import SamplingProfiler
+from backend.inference_scheduler import BoundedExecutor, MicroBatchScheduler, Overloaded
 
 # --- Flask 应用初始化 ---
 # 将前端目录 `../frontend` 设置为静态文件目录，
@@ -17,108 +24,178 @@ CORS(app) # 允许跨域请求
 
 # --- 全局变量 ---
 # *** 修复 #1: 更新模型路径以匹配新的表格模型训练脚本 ***
-MODEL_PATH = os.path.join('models', 'ag-aqi-predictor-tabular')
-DATA_PATH = os.path.join('data', 'final_data.csv')
-predictor = None
-
-def load_model():
-    """在服务启动时加载训练好的AutoGluon模型。"""
-    global predictor
-    if not os.path.exists(MODEL_PATH):
-        print(f"错误: 模型目录未找到于 {MODEL_PATH}")
-        print("请首先通过运行 `python ml/train.py` 来训练模型。")
-        predictor = None
-        return
-        
-    try:
-        predictor = TabularPredictor.load(MODEL_PATH)
-        print("模型加载成功。")
-    except Exception as e:
-        print(f"加载模型时出错: {e}")
-        predictor = None
+# 如果 `ml/train.py` 导出了推理优化后的部署模型，则优先使用它
+FULL_MODEL_PATH = os.path.join('models', 'ag-aqi-predictor-tabular')
+DEPLOY_MODEL_PATH = os.path.join('models', 'ag-aqi-predictor-tabular-deploy')
+MODEL_PATH = DEPLOY_MODEL_PATH if os.path.exists(DEPLOY_MODEL_PATH) else FULL_MODEL_PATH
+# 优先使用 `ml/prepare_data.py` 生成的 Arrow 文件 (内存映射读取)，否则回退到 CSV
+DATA_PATH = ARROW_PATH if os.path.exists(ARROW_PATH) else CSV_PATH
+# 预测结果缓存: 同一城市、同一预测日期、同一模型版本的结果只需计算一次
+PREDICTION_CACHE_SIZE = int(os.environ.get('AQI_PREDICTION_CACHE_SIZE', 1024))
+PREDICTION_CACHE_TTL = float(os.environ.get('AQI_PREDICTION_CACHE_TTL', 3600))
+# 微批调度: 并发的单城市预测请求在该时间窗口内 (或凑满指定行数时) 合并为一次模型调用
+BATCH_WINDOW_MS = float(os.environ.get('AQI_BATCH_WINDOW_MS', 5))
+BATCH_MAX_ROWS = int(os.environ.get('AQI_BATCH_MAX_ROWS', 64))
+# 等待合批的请求上限，超出时直接返回 503 (0 表示不限)
+MAX_QUEUED_REQUESTS = int(os.environ.get('AQI_MAX_QUEUED_REQUESTS', 256))
+# 推理线程数和排队上限: 同时运行的推理不超过 AQI_INFERENCE_THREADS 个，
+# 另有最多 AQI_MAX_PENDING_INFERENCES 个排队，超出时直接返回 503
+INFERENCE_THREADS = int(os.environ.get('AQI_INFERENCE_THREADS', 2))
+MAX_PENDING_INFERENCES = int(os.environ.get('AQI_MAX_PENDING_INFERENCES', 32))
+# 批量预测端点单次请求允许的最大条目数
+MAX_BATCH_SIZE = int(os.environ.get('AQI_MAX_BATCH_SIZE', 1000))
+# 模型加载模式: eager (启动时同步加载), background (后台线程加载), lazy (首次预测时加载)
+MODEL_LOAD_MODE = os.environ.get('AQI_MODEL_LOAD_MODE', 'background')
+# 多城市注册表: 每个城市对应的特征数据和模型目录 (见 `backend/model_registry.py`)，
+# 文件不存在时只服务默认城市，使用上面的 MODEL_PATH 和 DATA_PATH
+REGISTRY_PATH = os.environ.get('AQI_REGISTRY_PATH', os.path.join('models', 'registry.json'))
+# 常驻内存模型的总大小上限 (MB)，超出时淘汰最久未使用的模型
+MODEL_MEMORY_MB = float(os.environ.get('AQI_MODEL_MEMORY_MB', 4096))
+# 采样分析器开关: 设置为 1 时可通过 /debug/profiler/* 在运行中开始/停止采样
+PROFILER_ENABLED = os.environ.get('AQI_PROFILER_ENABLED', '0') == '1'
+DEFAULT_CITY = 'chicago'
+
+def _on_model_loaded(predictor, timings):
+    """模型加载完成后: 记录加载耗时，并为常驻内存的每个子模型加上计时。"""
+    if "total_seconds" in timings:
+        metrics.STAGE_SECONDS.observe(timings["total_seconds"], stage='model_load')
+    timed_models = metrics.instrument_ensemble_members(predictor)
+    if timed_models:
+        print(f"已为子模型启用计时: {timed_models}")
+
+registry = ModelRegistry(
+    load_registry_config(REGISTRY_PATH, MODEL_PATH, DATA_PATH, default_city=DEFAULT_CITY),
+    memory_budget_mb=MODEL_MEMORY_MB,
+    on_load=_on_model_loaded,
+)
+prediction_cache = PredictionCache(maxsize=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL)
+# 多日预测由定时任务 (`python -m ml.forecast`) 预先计算，请求时直接查表
+forecast_store = ForecastStore(os.environ.get('AQI_FORECAST_PATH', FORECAST_PATH))
+inference_executor = BoundedExecutor(max_workers=INFERENCE_THREADS, max_pending=MAX_PENDING_INFERENCES)
+profiler = SamplingProfiler()
+
+def run_inference(input_df, model):
+    """调用模型预测，并记录推理耗时。"""
+    with metrics.stage_timer('inference'):
+        return model.predict(input_df)
 
-def get_prediction_input():
+scheduler = MicroBatchScheduler(
+    run_inference,
+    max_wait_ms=BATCH_WINDOW_MS,
+    max_batch_rows=BATCH_MAX_ROWS,
+    executor=inference_executor,
+    max_queue=MAX_QUEUED_REQUESTS,
+)
+
+def default_model():
+    """返回默认城市 (未注册时为第一个注册城市) 的模型，启动预加载和就绪检查以它为准。"""
+    entry = registry.get(DEFAULT_CITY) or registry.get(registry.cities()[0])
+    return entry.model
+
+def load_model(handle=None):
+    """加载模型 (默认为默认城市的模型)，各阶段耗时记录在 `handle.status` 中。"""
+    return registry.load(handle or default_model())
+
+def start_model_loading():
+    """根据 MODEL_LOAD_MODE 在服务启动时触发默认模型的加载，其他城市的模型在首次请求时加载。"""
+    if MODEL_LOAD_MODE == 'eager':
+        load_model()
+    elif MODEL_LOAD_MODE == 'background':
+        _start_background_load(default_model())
+    # lazy 模式: 等到第一次预测请求时再加载
+
+def _start_background_load(handle):
+    handle.status.update(state="loading", error=None)
+    threading.Thread(target=registry.load, args=(handle,), name='model-loader', daemon=True).start()
+
+def ensure_model_loaded(handle):
+    """
+    在 with 块内占用并产出模型的预测器，不可用时产出 None。未加载或已被淘汰的模型:
+    background 模式下转入后台加载 (本次产出 None)，其他模式下同步加载。
+    占用期间该模型不会被注册表淘汰。
     """
-    *** 修复 #2: 重写此函数以在推理时正确生成所需的特征工程 ***
+    if handle.predictor is None and handle.status["state"] in ("not_loaded", "evicted"):
+        if MODEL_LOAD_MODE == 'background':
+            _start_background_load(handle)
+        else:
+            registry.load(handle)
+    return registry.use(handle)
 
-    为预测创建特征输入。此函数现在会:
-    1. 读取最近的历史数据。
-    2. 计算与训练时完全相同的滑动平均和其他特征。
-    3. 返回一个与模型期望的输入格式完全匹配的DataFrame。
+def overloaded_response():
+    """推理过载时的 503 响应，提示客户端稍后重试。"""
+    response = jsonify({"error": "服务器繁忙，请稍后重试。"})
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+def model_unavailable_error(handle):
+    """返回模型不可用时的 (错误信息, HTTP状态码)。"""
+    if handle.status["state"] in ("loading", "not_loaded", "evicted"):
+        return "模型正在加载中，请稍后重试。", 503
+    return "模型尚未加载，请检查服务器日志。", 500
+
+def get_prediction_input(city='chicago', model=None):
+    """
+    为预测创建特征输入。
+
+    特征由该城市在注册表中的特征存储提供: 历史数据只在首次请求或数据文件变化时读取，
+    滑动平均等特征的计算逻辑与训练时完全相同 (见 `backend/feature_store.py`)。
+    返回一个与模型期望的输入格式完全匹配的DataFrame及其对应的预测日期。
     """
+    entry = registry.get(city)
+    if entry is None:
+        return None, None
     try:
-        df = pd.read_csv(DATA_PATH, parse_dates=['date'])
-        
-        # 使用最新的数据来模拟第二天的输入
-        last_known_record = df.tail(1).iloc[0]
-        next_day = last_known_record['date'] + datetime.timedelta(days=1)
-        
-        # 准备一个包含足够历史数据的临时df来计算滑动平均
-        # 我们需要至少6天的历史数据来为新的一天计算7日滑动平均
-        history_df = df.tail(6).copy()
-        # 将最新的真实数据添加到这个历史记录的末尾
-        new_row = pd.DataFrame([last_known_record])
-        history_df = pd.concat([history_df, new_row], ignore_index=True)
-        history_df.set_index('date', inplace=True)
-
-        # 为新的一天计算滑动平均特征
-        rolling_features = ['pm25', 'o3', 'TEMP', 'WDSP']
-        new_features = {}
-        for feature in rolling_features:
-            # 计算7天滑动平均值 (包括今天)
-            rolling_mean = history_df[feature].rolling(window=7, min_periods=1).mean().iloc[-1]
-            new_features[f'{feature}_7d_mean'] = rolling_mean
-            
-        # 准备最终的输入DataFrame
-        input_df = pd.DataFrame({
-            # 原始特征 (使用最后一天的值作为预估)
-            'pm25': [last_known_record['pm25']],
-            'o3': [last_known_record['o3']],
-            'TEMP': [last_known_record['TEMP']],
-            'WDSP': [last_known_record['WDSP']],
-            'PRCP': [last_known_record['PRCP']],
-            # 时间特征
-            'month': [next_day.month],
-            'day_of_year': [next_day.dayofyear],
-            'weekday': [next_day.weekday()],
-            # 新的滑动平均特征
-            'pm25_7d_mean': [new_features['pm25_7d_mean']],
-            'o3_7d_mean': [new_features['o3_7d_mean']],
-            'TEMP_7d_mean': [new_features['TEMP_7d_mean']],
-            'WDSP_7d_mean': [new_features['WDSP_7d_mean']],
-        })
+        features = entry.features.get(city)
+        if features is None:
+            print(f"特征存储中没有城市 {city} 的数据")
+            return None, None
+        input_df, next_day = features
 
         # 确保列的顺序和模型训练时一致
-        if predictor:
-            input_df = input_df[predictor.features()]
+        if model is not None:
+            input_df = input_df[model.features()]
 
-        return input_df
+        return input_df, next_day
 
     except FileNotFoundError:
-        print(f"数据文件未找到于 {DATA_PATH}")
-        return None
+        print(f"数据文件未找到于 {entry.features.data_path}")
+        return None, None
     except Exception as e:
         print(f"为预测准备输入数据时出错: {e}")
-        return None
+        return None, None
 
 @app.route('/api/predict/<city>', methods=['GET'])
 def predict(city):
     """API端点，用于获取指定城市的AQI预测结果。"""
-    if predictor is None:
-        return jsonify({"error": "模型尚未加载，请检查服务器日志。"}), 500
-
-    # 注意：在此原型中，我们仅支持 'chicago'。
-    # 在生产环境中，这里会有一个系统来处理不同城市的数据。
-    if city.lower() != 'chicago':
+    # 可服务的城市及其数据和模型由注册表决定
+    entry = registry.get(city)
+    if entry is None:
         return jsonify({"error": "在此原型中尚不支持该城市。"}), 404
 
-    input_features = get_prediction_input()
-    if input_features is None:
-        return jsonify({"error": "无法为预测生成输入特征。"}), 500
+    with ensure_model_loaded(entry.model) as model:
+        if model is None:
+            message, status_code = model_unavailable_error(entry.model)
+            return jsonify({"error": message}), status_code
+
+        with metrics.stage_timer('feature_build'):
+            input_features, next_day = get_prediction_input(city, model)
+        if input_features is None:
+            return jsonify({"error": "无法为预测生成输入特征。"}), 500
 
-    prediction = predictor.predict(input_features)
-    predicted_aqi = int(prediction.iloc[0])
+        # 相同的 (城市, 预测日期, 模型指纹) 只运行一次集成模型推理
+        cache_key = (city.lower(), next_day.date(), entry.model.fingerprint)
+        try:
+            predicted_aqi = prediction_cache.get_or_compute(
+                cache_key, lambda: int(scheduler.predict(input_features, model).iloc[0])
+            )
+        except Overloaded:
+            return overloaded_response()
 
+    with metrics.stage_timer('response'):
+        return jsonify(build_prediction_response(city, predicted_aqi))
+
+def build_prediction_response(city, predicted_aqi):
+    """根据预测的AQI值构建返回给前端的结果 (等级、健康建议和图片)。"""
     category, health_info, level_code = get_aqi_category(predicted_aqi)
 
     # --- GenAI 图片模拟 ---
@@ -128,7 +205,7 @@ def predict(city):
     image_name = f"{level_code}.png"
     image_url = f"images/{image_name}"
 
-    response = {
+    return {
         "city": city.capitalize(),
         "predicted_aqi": predicted_aqi,
         "category": category,
@@ -136,7 +213,192 @@ def predict(city):
         "image_url": image_url
     }
 
-    return jsonify(response)
+@app.route('/api/forecast/<city>', methods=['GET'])
+def forecast(city):
+    """
+    多日预测端点: `/api/forecast/<city>?days=N` 返回未来 N 天 (默认为预测表覆盖的全部天数)
+    的AQI预测及分位数区间。结果来自预计算的预测表，不会在请求时调用时间序列模型。
+    """
+    try:
+        horizon = forecast_store.horizon()
+    except FileNotFoundError:
+        print(f"预测表未找到于 {forecast_store.path}")
+        return jsonify({"error": "预测表尚未生成，请先运行 `python -m ml.forecast`。"}), 503
+
+    days = request.args.get("days")
+    if days is not None:
+        try:
+            days = int(days)
+        except ValueError:
+            days = 0
+        if not 1 <= days <= horizon:
+            return jsonify({"error": f"days 必须是 1 到 {horizon} 之间的整数。"}), 400
+
+    rows = forecast_store.get(city, days)
+    if rows is None:
+        return jsonify({"error": "在此原型中尚不支持该城市。"}), 404
+
+    return jsonify({
+        "city": city.capitalize(),
+        "generated_at": forecast_store.metadata.get("generated_at"),
+        "forecast": rows,
+    })
+
+@app.route('/api/predict/batch', methods=['POST'])
+def predict_batch():
+    """
+    批量预测端点。请求体为 {"items": [{"city": "chicago", "date": "2023-10-05"}, ...]}，
+    `date` 为预测日期，省略时表示该城市最新可预测的一天。
+    有效请求按 (特征存储, 模型) 分组，每组的特征被组装成一个矩阵，只调用一次 `predict`。
+    """
+    body = request.get_json(silent=True)
+    items = body.get("items") if isinstance(body, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "请求体必须包含非空的 items 列表。"}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"单次批量请求最多支持 {MAX_BATCH_SIZE} 项。"}), 400
+
+    results = [None] * len(items)
+    groups = {}  # (特征存储, 模型) -> [(位置, 城市, 预测日期)]
+    for position, item in enumerate(items):
+        if not isinstance(item, dict) or not isinstance(item.get("city"), str):
+            results[position] = {"error": "每一项都必须包含 city 字段。"}
+            continue
+        city = item["city"]
+        target_date = item.get("date")
+        if target_date is not None:
+            try:
+                target_date = datetime.date.fromisoformat(target_date)
+            except (TypeError, ValueError):
+                results[position] = {"city": city.capitalize(), "error": "日期格式无效，应为 YYYY-MM-DD。"}
+                continue
+        entry = registry.get(city)
+        if entry is None:
+            results[position] = {"city": city.capitalize(), "error": "在此原型中尚不支持该城市。"}
+            continue
+        groups.setdefault((entry.features, entry.model), []).append((position, city, target_date))
+
+    for (store, handle), group in groups.items():
+        with ensure_model_loaded(handle) as model:
+            if model is None:
+                message, _ = model_unavailable_error(handle)
+                for position, city, _ in group:
+                    results[position] = {"city": city.capitalize(), "error": message}
+                continue
+
+            try:
+                input_df, target_dates, errors = store.build_batch([(city, d) for _, city, d in group])
+            except FileNotFoundError:
+                print(f"数据文件未找到于 {store.data_path}")
+                return jsonify({"error": "无法为预测生成输入特征。"}), 500
+
+            for index, message in errors.items():
+                position, city, _ = group[index]
+                results[position] = {"city": city.capitalize(), "error": message}
+
+            if not input_df.empty:
+                try:
+                    predictions = inference_executor.submit(run_inference, input_df[model.features()], model).result()
+                except Overloaded:
+                    return overloaded_response()
+                for index, target_date, value in zip(input_df.index, target_dates, predictions):
+                    position, city, _ = group[index]
+                    result = build_prediction_response(city, int(value))
+                    result["date"] = target_date.date().isoformat()
+                    results[position] = result
+
+    return jsonify({"results": results})
+
+@app.route('/api/stats')
+def stats():
+    """返回预测缓存、微批调度器、推理线程池和模型注册表的统计信息。"""
+    return jsonify({
+        "prediction_cache": prediction_cache.stats(),
+        "scheduler": scheduler.stats(),
+        "inference": inference_executor.stats(),
+        "models": registry.stats(),
+    })
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 文本格式的指标: 各阶段和子模型的耗时直方图、HTTP 请求计数，以及缓存/调度器/线程池的统计。"""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+def _collect_runtime_stats():
+    cache = prediction_cache.stats()
+    batching = scheduler.stats()
+    inference = inference_executor.stats()
+    models = registry.stats()
+    return [
+        ('aqi_prediction_cache_hits_total', '预测缓存命中数', 'counter', [({}, cache["hits"])]),
+        ('aqi_prediction_cache_misses_total', '预测缓存未命中数', 'counter', [({}, cache["misses"])]),
+        ('aqi_prediction_cache_size', '预测缓存条目数', 'gauge', [({}, cache["size"])]),
+        ('aqi_scheduler_queue_depth', '微批调度器当前队列深度', 'gauge', [({}, batching["queue_depth"])]),
+        ('aqi_scheduler_batches_total', '微批调度器执行的批次数', 'counter', [({}, batching["batches"])]),
+        ('aqi_inference_in_flight', '运行中和排队中的推理数', 'gauge', [({}, inference["in_flight"])]),
+        ('aqi_inference_rejected_total', '因过载被拒绝的推理数', 'counter',
+         [({}, inference["rejected"] + batching["rejected"])]),
+        ('aqi_resident_models', '常驻内存的模型数', 'gauge', [({}, len(models["resident_models"]))]),
+        ('aqi_model_evictions_total', '被淘汰的模型数', 'counter', [({}, models["evictions"])]),
+    ]
+
+metrics.registry.register_collector(_collect_runtime_stats)
+
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def _record_request(response):
+    # 以路由规则 (而不是实际路径) 作为标签，避免城市名等参数造成标签爆炸
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    start = g.get('request_start')
+    if start is not None:
+        metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+    metrics.HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/debug/profiler', methods=['GET'])
+def profiler_status():
+    """采样分析器状态 (需设置 AQI_PROFILER_ENABLED=1)。"""
+    if not PROFILER_ENABLED:
+        return jsonify({"error": "采样分析器未启用。"}), 404
+    return jsonify(profiler.status())
+
+@app.route('/debug/profiler/start', methods=['POST'])
+def profiler_start():
+    """开始采样，可通过 `?interval_ms=` 指定采样间隔 (默认 5 毫秒)。"""
+    if not PROFILER_ENABLED:
+        return jsonify({"error": "采样分析器未启用。"}), 404
+    interval_ms = request.args.get("interval_ms", 5.0, type=float)
+    if not profiler.start(interval_ms=max(interval_ms, 0.5)):
+        return jsonify({"error": "采样分析器已在运行。"}), 409
+    return jsonify(profiler.status())
+
+@app.route('/debug/profiler/stop', methods=['POST'])
+def profiler_stop():
+    """停止采样，返回折叠格式的调用栈 (可用 flamegraph.pl 或 speedscope 查看)。"""
+    if not PROFILER_ENABLED:
+        return jsonify({"error": "采样分析器未启用。"}), 404
+    return Response(profiler.stop(), mimetype='text/plain')
+
+@app.route('/health')
+def health():
+    """存活检查: 只要进程能处理请求就返回 200，不依赖模型是否加载完成。"""
+    return jsonify({"status": "ok"})
+
+@app.route('/ready')
+def ready():
+    """就绪检查: 默认模型加载完成后返回 200，否则返回 503 及当前加载状态。"""
+    handle = default_model()
+    body = {
+        "model_path": handle.model_path,
+        "load_mode": MODEL_LOAD_MODE,
+        **handle.status,
+        "models": {h.model_path: h.status["state"] for h in registry.models()},
+    }
+    # 被淘汰的模型会在下次请求时重新加载，不影响就绪状态
+    return jsonify(body), 200 if handle.status["state"] in ("ready", "evicted") else 503
 
 @app.route('/')
 def index():
@@ -144,5 +406,6 @@ def index():
     return app.send_static_file('index.html')
 
 if __name__ == '__main__':
-    load_model() # 服务启动时加载模型
+    # 单进程开发服务器；生产环境请使用 `backend/wsgi.py` (gunicorn, 多 worker 共享预加载的模型)
+    start_model_loading() # 按配置的模式加载模型，首页和健康检查可立即访问
     app.run(debug=True, port=5000) 
\ No newline at end of file
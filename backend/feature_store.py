@@ -0,0 +1,260 @@
+import datetime
+import hashlib
+import io
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from backend.metrics import stage_timer
+from ml.storage import read_arrow_table
+
+# --- 特征定义 ---
+# 与 ml/prepare_data.py 中的特征工程保持一致
+ROLLING_FEATURES = ['pm25', 'o3', 'TEMP', 'WDSP']
+RAW_FEATURES = ['pm25', 'o3', 'TEMP', 'WDSP', 'PRCP']
+FEATURE_COLUMNS = RAW_FEATURES + ['month', 'day_of_year', 'weekday'] + [f'{f}_7d_mean' for f in ROLLING_FEATURES]
+WINDOW_DAYS = 7
+DEFAULT_CITY = 'chicago'
+
+
+def build_feature_row(history_df):
+    """
+    根据按日期排序的最近历史记录 (至少1行) 生成下一天的单行特征DataFrame。
+
+    计算逻辑与训练时完全相同: 取最近6天的数据再追加最后一天的真实记录，
+    计算7日滑动平均，并以最后一天的观测值作为第二天原始特征的预估。
+    """
+    last_known_record = history_df.iloc[-1]
+    next_day = last_known_record['date'] + datetime.timedelta(days=1)
+
+    # 我们需要至少6天的历史数据来为新的一天计算7日滑动平均
+    window_df = pd.concat(
+        [history_df.tail(WINDOW_DAYS - 1), history_df.tail(1)],
+        ignore_index=True,
+    ).set_index('date')
+
+    input_row = {
+        # 原始特征 (使用最后一天的值作为预估)
+        'pm25': [last_known_record['pm25']],
+        'o3': [last_known_record['o3']],
+        'TEMP': [last_known_record['TEMP']],
+        'WDSP': [last_known_record['WDSP']],
+        'PRCP': [last_known_record['PRCP']],
+        # 时间特征
+        'month': [next_day.month],
+        'day_of_year': [next_day.dayofyear],
+        'weekday': [next_day.weekday()],
+    }
+    # 滑动平均特征 (包括今天)
+    for feature in ROLLING_FEATURES:
+        rolling_mean = window_df[feature].rolling(window=WINDOW_DAYS, min_periods=1).mean().iloc[-1]
+        input_row[f'{feature}_7d_mean'] = [rolling_mean]
+
+    return pd.DataFrame(input_row), next_day
+
+
+class FeatureStore:
+    """
+    内存特征存储: 历史数据文件只在首次访问时完整读取一次，
+    之后为每个城市缓存历史记录和最新的特征向量。
+
+    每次查询只需一次 `os.stat` 检查文件的 mtime/size:
+    - 文件未变化: 直接返回缓存的特征 (字典查找)。
+    - 文件只是在末尾追加了数据 (已解析部分的字节未变): 仅解析新增的字节并增量更新。
+    - 其他任何变化 (被替换、截断或原地重写): 重新完整加载。
+
+    数据文件可以是 CSV，也可以是 `ml/prepare_data.py` 生成的 Arrow IPC 文件 (`.arrow`)。
+    后者通过内存映射读取，无需解析文本；Arrow 文件不支持追加，变化后总是重新加载。
+    """
+
+    def __init__(self, data_path, default_city=DEFAULT_CITY):
+        self.data_path = data_path
+        self.default_city = default_city
+        self._lock = threading.Lock()
+        self._signature = None   # (inode, mtime_ns, size)
+        self._offset = 0         # 已解析到的字节偏移量
+        self._prefix_digest = None  # 已解析部分 (前 _offset 字节) 的 SHA-1，用于识别原地重写
+        self._header = None      # CSV 列名, 用于解析追加的数据
+        self._history = {}       # city -> 按日期排序的历史记录 DataFrame
+        self._features = {}      # city -> (单行特征 DataFrame, 预测日期)
+        self._batch_arrays = {}  # city -> 批量预测用的预计算数组 (按需生成)
+
+    def get(self, city):
+        """返回指定城市的 (特征DataFrame, 预测日期)，若无数据则返回 None。"""
+        self.refresh()
+        return self._features.get(city.lower())
+
+    def cities(self):
+        self.refresh()
+        return sorted(self._features)
+
+    def history(self, city):
+        """返回指定城市按日期排序的历史记录，若无数据则返回 None。"""
+        self.refresh()
+        return self._history.get(city.lower())
+
+    def refresh(self):
+        """在数据文件发生变化时刷新缓存。文件不存在时抛出 FileNotFoundError。"""
+        st = os.stat(self.data_path)
+        signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if signature == self._signature:
+            return
+
+        with self._lock:
+            # 其他线程可能已经完成了刷新
+            if signature == self._signature:
+                return
+            previous = self._signature
+            appendable = not self.data_path.endswith('.arrow')
+            if appendable and previous is not None and previous[0] == st.st_ino and st.st_size >= self._offset:
+                with stage_timer('data_append'):
+                    self._load_appended()
+            else:
+                with stage_timer('data_load'):
+                    self._load_full()
+            self._signature = signature
+
+    def _load_full(self, raw=None):
+        if self.data_path.endswith('.arrow'):
+            df = read_arrow_table(self.data_path).to_pandas()
+        else:
+            if raw is None:
+                with open(self.data_path, 'rb') as f:
+                    raw = f.read()
+            # 末尾未写完的行留到下一次刷新
+            end = raw.rfind(b'\n') + 1 or len(raw)
+            df = pd.read_csv(io.BytesIO(raw[:end]), parse_dates=['date'])
+            self._header = list(df.columns)
+            self._offset = end
+            self._prefix_digest = hashlib.sha1(raw[:end]).digest()
+        # 在新的字典中构建完成后再整体替换，并发的查询不会看到空的存储
+        history, features = {}, {}
+        self._update(df, history, features)
+        self._history, self._features, self._batch_arrays = history, features, {}
+        print(f"特征存储已从 {self.data_path} 完整加载 {len(df)} 行数据。")
+
+    def _load_appended(self):
+        with open(self.data_path, 'rb') as f:
+            raw = f.read()
+        # 原地重写 (例如 `to_csv` 覆盖同一个文件) 不会改变 inode，文件也可能变长，
+        # 只有已解析部分的字节完全相同时才是追加，否则重新完整加载
+        if len(raw) < self._offset or hashlib.sha1(raw[:self._offset]).digest() != self._prefix_digest:
+            self._load_full(raw)
+            return
+        chunk = raw[self._offset:]
+        # 只解析完整的行，未写完的行留到下一次刷新
+        end = chunk.rfind(b'\n') + 1
+        if end == 0:
+            return
+        new_df = pd.read_csv(io.BytesIO(chunk[:end]), header=None, names=self._header, parse_dates=['date'])
+        self._offset += end
+        self._prefix_digest = hashlib.sha1(raw[:self._offset]).digest()
+        if not new_df.empty:
+            self._update(new_df, self._history, self._features)
+            print(f"特征存储增量加载了 {len(new_df)} 行新数据。")
+
+    def _update(self, df, history_by_city, features_by_city):
+        if 'city' in df.columns:
+            groups = df.groupby(df['city'].str.lower(), sort=False)
+        else:
+            groups = [(self.default_city, df)]
+
+        for city, city_df in groups:
+            history = history_by_city.get(city)
+            if history is not None:
+                city_df = pd.concat([history, city_df], ignore_index=True)
+            history = city_df.reset_index(drop=True)
+            history_by_city[city] = history
+            features_by_city[city] = build_feature_row(history.tail(WINDOW_DAYS))
+            self._batch_arrays.pop(city, None)
+
+    def build_batch(self, requests):
+        """
+        为一批 (城市, 预测日期) 请求构建一个特征矩阵，预测日期为 None 表示该城市最新可预测的一天。
+
+        与 `build_feature_row` 的逻辑相同: 以预测日期前一天的记录作为原始特征，
+        滑动平均为其之前6天的数据再加上前一天记录的均值。每个城市的滑动和与计数只在
+        数据变化后计算一次，之后整批请求只需 `np.searchsorted` 定位和数组索引。
+
+        返回 (特征DataFrame, 预测日期列表, 错误字典)。DataFrame 的索引是有效请求在
+        `requests` 中的位置，错误字典把无效请求的位置映射到错误信息。
+        """
+        self.refresh()
+        with stage_timer('feature_batch'):
+            return self._build_batch(requests)
+
+    def _build_batch(self, requests):
+        frames = []
+        target_dates = {}
+        errors = {}
+
+        positions_by_city = {}
+        for position, (city, target_date) in enumerate(requests):
+            positions_by_city.setdefault(city.lower(), []).append((position, target_date))
+
+        for city, items in positions_by_city.items():
+            arrays = self._get_batch_arrays(city)
+            if arrays is None:
+                for position, _ in items:
+                    errors[position] = "在此原型中尚不支持该城市。"
+                continue
+
+            dates = arrays['date']
+            latest_target = dates[-1] + np.timedelta64(1, 'D')
+            targets = np.array(
+                [latest_target if d is None else np.datetime64(pd.Timestamp(d).normalize(), 'ns') for _, d in items],
+                dtype='datetime64[ns]',
+            )
+            # 每个预测日期对应的最后一条已知记录 (预测日期前一天或更早)
+            last_index = np.searchsorted(dates, targets, side='left') - 1
+            valid = (last_index >= 0) & (targets <= latest_target)
+            for (position, _), ok in zip(items, valid):
+                if not ok:
+                    errors[position] = "请求的日期超出了可预测的范围。"
+            if not valid.any():
+                continue
+
+            idx = last_index[valid]
+            target_index = pd.DatetimeIndex(targets[valid])
+            columns = {feature: arrays[feature][idx] for feature in RAW_FEATURES}
+            columns['month'] = target_index.month.astype('int64')
+            columns['day_of_year'] = target_index.dayofyear.astype('int64')
+            columns['weekday'] = target_index.weekday.astype('int64')
+            for feature in ROLLING_FEATURES:
+                last_value = arrays[feature][idx]
+                present = ~np.isnan(last_value)
+                total = arrays[f'{feature}_sum'][idx] + np.where(present, last_value, 0.0)
+                count = arrays[f'{feature}_count'][idx] + present
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    columns[f'{feature}_7d_mean'] = np.where(count > 0, total / count, np.nan)
+
+            city_positions = [position for (position, _), ok in zip(items, valid) if ok]
+            frames.append(pd.DataFrame(columns, index=city_positions))
+            target_dates.update(zip(city_positions, target_index))
+
+        if frames:
+            input_df = pd.concat(frames).sort_index()
+        else:
+            input_df = pd.DataFrame(columns=FEATURE_COLUMNS)
+        return input_df, [target_dates[position] for position in input_df.index], errors
+
+    def _get_batch_arrays(self, city):
+        arrays = self._batch_arrays.get(city)
+        if arrays is not None:
+            return arrays
+        history = self._history.get(city)
+        if history is None:
+            return None
+
+        arrays = {'date': history['date'].to_numpy(dtype='datetime64[ns]')}
+        for feature in RAW_FEATURES:
+            arrays[feature] = history[feature].to_numpy(dtype=float)
+        for feature in ROLLING_FEATURES:
+            # 截至每一行 (含) 的最近6天之和与有效值个数，NaN 不计入
+            rolling = history[feature].rolling(window=WINDOW_DAYS - 1, min_periods=1)
+            arrays[f'{feature}_sum'] = np.nan_to_num(rolling.sum().to_numpy(dtype=float))
+            arrays[f'{feature}_count'] = rolling.count().to_numpy(dtype=float)
+        self._batch_arrays[city] = arrays
+        return arrays
@@ -0,0 +1,70 @@
+import json
+import os
+import threading
+
+from ml.aqi import get_aqi_category
+from ml.storage import read_arrow_table
+
+
+class ForecastStore:
+    """
+    预计算预测表 (由 `ml/forecast.py` 生成) 的内存视图。
+
+    表文件只在首次访问或被定时任务替换后读取一次 (内存映射)，
+    读取时即为每个城市生成可直接返回的逐日预测列表，
+    之后每次查询只需一次 `os.stat` 和一次字典查找加切片，不会调用时间序列模型。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = None   # (inode, mtime_ns, size)
+        self._items = {}         # city -> 按日期排序的逐日预测列表
+        self.metadata = {}
+
+    def get(self, city, days=None):
+        """返回指定城市最近 `days` 天 (默认全部) 的预测列表，城市不在表中时返回 None。"""
+        self.refresh()
+        rows = self._items.get(city.lower())
+        return None if rows is None else rows[:days]
+
+    def horizon(self):
+        """预测表覆盖的天数。"""
+        self.refresh()
+        return self.metadata.get('prediction_length', 0)
+
+    def refresh(self):
+        """在表文件发生变化时重新加载。文件不存在时抛出 FileNotFoundError。"""
+        st = os.stat(self.path)
+        signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if signature == self._signature:
+            return
+        with self._lock:
+            if signature != self._signature:
+                self._load()
+                self._signature = signature
+
+    def _load(self):
+        table = read_arrow_table(self.path)
+        metadata = json.loads((table.schema.metadata or {}).get(b'forecast', b'{}'))
+        df = table.to_pandas()
+        quantiles = [c for c in df.columns if c not in ('item_id', 'timestamp', 'mean')]
+
+        items = {}
+        for item_id, group in df.groupby('item_id', sort=False):
+            rows = []
+            for values in group.to_dict('records'):
+                # AQI 不可能为负，模型的预测值在此截断
+                aqi = max(0, int(round(float(values['mean']))))
+                category, _, level_code = get_aqi_category(aqi)
+                rows.append({
+                    "date": values['timestamp'].date().isoformat(),
+                    "predicted_aqi": aqi,
+                    "category": category,
+                    "level": level_code,
+                    "quantiles": {q: round(max(0.0, float(values[q])), 1) for q in quantiles},
+                })
+            items[item_id.lower()] = rows
+        self._items = items
+        self.metadata = metadata
+        print(f"预测表已从 {self.path} 加载 {len(items)} 个城市的预测。")
@@ -0,0 +1,12 @@
+# gunicorn 配置: gunicorn -c backend/gunicorn.conf.py backend.wsgi:app
+import os
+
+bind = os.environ.get('AQI_BIND', '0.0.0.0:5000')
+# worker 进程数: 每个进程共享预加载的模型内存页
+workers = int(os.environ.get('AQI_WORKERS', 2))
+# 每个 worker 处理请求的线程数；推理并发另由 AQI_INFERENCE_THREADS 和 AQI_MAX_PENDING_INFERENCES 限制
+worker_class = 'gthread'
+threads = int(os.environ.get('AQI_THREADS', 8))
+# 在主进程中导入应用 (加载模型) 后再 fork 出 worker
+preload_app = True
+timeout = int(os.environ.get('AQI_WORKER_TIMEOUT', 60))
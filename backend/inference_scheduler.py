@@ -0,0 +1,195 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+class Overloaded(Exception):
+    """推理已达到并发上限且等待队列已满，调用方应返回 503 让客户端稍后重试。"""
+
+
+class BoundedExecutor:
+    """
+    有界的推理线程池: 最多 `max_workers` 个推理同时运行，另有最多 `max_pending` 个排队等待。
+    超出时 `submit` 立即抛出 Overloaded，而不是让请求无限堆积、拖慢所有请求。
+
+    线程在第一次提交时才创建，因此可以在 fork 之前 (预加载模型时) 安全地构造。
+    """
+
+    def __init__(self, max_workers=2, max_pending=32):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='inference')
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise Overloaded(f"推理并发已达上限 ({self.max_workers} 个运行中, {self.max_pending} 个排队)")
+        with self._lock:
+            self.in_flight += 1
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, _future):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "threads": self.max_workers,
+                "max_pending": self.max_pending,
+                "in_flight": self.in_flight,
+                "rejected": self.rejected,
+            }
+
+
+class MicroBatchScheduler:
+    """
+    服务端微批调度器: 并发的预测请求先进入队列，后台线程在一个很短的时间窗口内
+    (或凑满 `max_batch_rows` 行时) 把它们合并成一个 DataFrame，只调用一次 `predict_fn`，
+    再把结果按顺序分发回各个请求。
+
+    这样并发请求不会在 GIL 和模型的本地库上相互争抢，
+    代价是每个请求最多增加 `max_wait_ms` 的排队延迟。
+
+    多模型服务时，每个请求可以附带它要使用的模型: 同一窗口内的请求按模型分组，
+    每组调用一次 `predict_fn(input_df, model)`。
+
+    提供 `executor` (BoundedExecutor) 时，合并后的批次交给它执行，调度线程不会被推理阻塞；
+    执行器已满时该批次的请求都会收到 Overloaded 异常。
+
+    `max_queue` 限制等待合批的请求数 (0 表示不限)，队列已满时 `submit` 立即抛出 Overloaded，
+    请求不会在调度队列中无限等待。
+    """
+
+    def __init__(self, predict_fn, max_wait_ms=5.0, max_batch_rows=64, executor=None, max_queue=0):
+        self.predict_fn = predict_fn
+        self.executor = executor
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_rows = max_batch_rows
+        self.max_queue = max_queue
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+
+        # 统计信息: 批大小直方图的桶为 2 的幂次 (上界)，最后一个桶为 max_batch_rows 及以上
+        self._buckets = [2 ** i for i in range(max(1, max_batch_rows).bit_length())]
+        if self._buckets[-1] < max_batch_rows:
+            self._buckets.append(max_batch_rows)
+        self._histogram = dict.fromkeys(self._buckets, 0)
+        self._histogram['+Inf'] = 0
+        self.batches = 0
+        self.rows = 0
+        self.max_queue_depth = 0
+        self.rejected = 0
+
+    def submit(self, input_df, model=None):
+        """提交一个 (可多行的) 特征 DataFrame，返回一个 Future，其结果为对应的预测 Series。"""
+        self._ensure_started()
+        future = Future()
+        try:
+            self._queue.put_nowait((input_df, model, future))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise Overloaded(f"调度队列已满 ({self.max_queue} 个请求等待合批)") from None
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return future
+
+    def predict(self, input_df, model=None):
+        """同步接口: 提交并等待预测结果。"""
+        return self.submit(input_df, model).result()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "max_queue": self.max_queue,
+                "rejected": self.rejected,
+                "max_wait_ms": self.max_wait * 1000,
+                "max_batch_rows": self.max_batch_rows,
+                "batches": self.batches,
+                "rows": self.rows,
+                "batch_size_histogram": {str(k): v for k, v in self._histogram.items()},
+            }
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='inference-scheduler', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            rows = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            # 在时间窗口内继续收集请求，直到凑满一批
+            while rows < self.max_batch_rows:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                rows += len(item[0])
+            # 同一模型的请求合并为一次调用 (按模型首次出现的顺序)
+            groups = {}
+            for item in batch:
+                groups.setdefault(id(item[1]), []).append(item)
+            for group in groups.values():
+                self._run_batch(group, sum(len(df) for df, _, _ in group))
+
+    def _run_batch(self, batch, rows):
+        with self._lock:
+            self.batches += 1
+            self.rows += rows
+            bucket = next((b for b in self._buckets if rows <= b), '+Inf')
+            self._histogram[bucket] += 1
+
+        try:
+            combined = pd.concat([df for df, _, _ in batch], ignore_index=True)
+            if self.executor is not None:
+                result = self.executor.submit(self.predict_fn, combined, batch[0][1])
+                result.add_done_callback(lambda f: self._deliver(batch, f))
+                return
+            predictions = self.predict_fn(combined, batch[0][1])
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        self._distribute(batch, predictions)
+
+    def _deliver(self, batch, result):
+        error = result.exception()
+        if error is not None:
+            self._fail(batch, error)
+        else:
+            self._distribute(batch, result.result())
+
+    @staticmethod
+    def _fail(batch, error):
+        for _, _, future in batch:
+            future.set_exception(error)
+
+    @staticmethod
+    def _distribute(batch, predictions):
+        predictions = np.asarray(predictions)
+        offset = 0
+        for df, _, future in batch:
+            future.set_result(pd.Series(predictions[offset:offset + len(df)], index=df.index))
+            offset += len(df)
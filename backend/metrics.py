@@ -0,0 +1,181 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# 延迟直方图的默认桶上界 (秒)，覆盖从亚毫秒级的查表到数秒的模型加载
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """单调递增计数器，可带标签。"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    """延迟直方图 (累计桶计数 + 总和 + 次数)，可带标签。"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}  # 标签值 -> [各桶计数 (非累计, 最后一个为 +Inf), 总和]
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+    指标注册表，按 Prometheus 文本格式 (0.0.4) 输出。
+
+    除了计数器和直方图，还可以注册采集回调: 它在每次抓取时被调用，
+    返回 [(名称, 说明, 类型, [(标签字典, 值), ...]), ...]，用于导出缓存命中数、队列深度等现有统计。
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collect):
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            for name, documentation, metric_type, samples in collect():
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+# --- 后端使用的全局指标 ---
+registry = MetricsRegistry()
+STAGE_SECONDS = registry.histogram(
+    'aqi_stage_duration_seconds',
+    '预测热路径各阶段耗时 (data_load, data_append, feature_build, feature_batch, inference, response, model_load)',
+    ['stage'],
+)
+MODEL_MEMBER_SECONDS = registry.histogram(
+    'aqi_model_member_duration_seconds', '集成模型中每个子模型单次预测的耗时', ['model'],
+)
+HTTP_REQUESTS = registry.counter(
+    'aqi_http_requests_total', 'HTTP 请求数', ['endpoint', 'method', 'status'],
+)
+HTTP_REQUEST_SECONDS = registry.histogram(
+    'aqi_http_request_duration_seconds', 'HTTP 请求处理耗时', ['endpoint'],
+)
+
+
+def stage_timer(stage):
+    """计时上下文管理器: `with stage_timer('inference'): ...` 的耗时记录到阶段直方图。"""
+    return STAGE_SECONDS.time(stage=stage)
+
+
+def instrument_ensemble_members(predictor):
+    """
+    为AutoGluon预测器中已常驻内存的每个子模型的 `predict_proba` 加上计时，
+    耗时记录到 `aqi_model_member_duration_seconds{model=...}`。
+
+    只包装实例属性，不修改模型文件。返回被计时的子模型名称；
+    预测器结构不符合预期时不做任何修改并返回空列表。
+    """
+    models = getattr(getattr(predictor, '_trainer', None), 'models', None)
+    if not isinstance(models, dict):
+        return []
+    instrumented = []
+    for name, model in models.items():
+        # 未常驻内存的子模型在 trainer.models 中只是路径字符串
+        original = getattr(model, 'predict_proba', None)
+        if isinstance(model, str) or original is None or getattr(original, '_aqi_timed', False):
+            continue
+
+        def timed(*args, _original=original, _name=name, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _original(*args, **kwargs)
+            finally:
+                MODEL_MEMBER_SECONDS.observe(time.perf_counter() - start, model=_name)
+
+        timed._aqi_timed = True
+        model.predict_proba = timed
+        instrumented.append(name)
+    return instrumented
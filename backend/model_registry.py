@@ -0,0 +1,233 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from backend.feature_store import FeatureStore
+from backend.prediction_cache import get_model_fingerprint
+
+
+def load_registry_config(path, default_model_path, default_data_path, default_city='chicago'):
+    """
+    读取城市注册表配置 (JSON)。文件不存在时返回只包含默认城市的配置。
+
+    配置格式::
+
+        {
+            "default": {"model_path": "models/ag-aqi-predictor-tabular", "data_path": "data/final_data.arrow"},
+            "cities": {
+                "chicago": {},
+                "new york": {"data_path": "data/new_york.arrow"},
+                "los angeles": {"model_path": "models/la", "data_path": "data/los_angeles.arrow"}
+            }
+        }
+
+    城市未指定的字段继承自 "default"。模型路径相同的城市共享同一个常驻模型，
+    数据路径相同的城市共享同一个特征存储 (此时数据文件需要有 `city` 列)。
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            config = json.load(f)
+    else:
+        config = {"cities": {default_city: {}}}
+    default = {"model_path": default_model_path, "data_path": default_data_path, **config.get("default", {})}
+    return {
+        city.lower(): {**default, **(settings or {})}
+        for city, settings in config.get("cities", {}).items()
+    }
+
+
+def _model_size_bytes(model_path, model_names):
+    """估算模型常驻内存的大小: 预测器本身及常驻子模型在磁盘上的序列化大小。"""
+    paths = [os.path.join(model_path, name) for name in ('predictor.pkl', 'learner.pkl')]
+    paths += [os.path.join(model_path, 'models', name) for name in model_names]
+    total = 0
+    for path in paths:
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+        elif os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+class ModelHandle:
+    """
+    一个模型目录及其加载状态。模型被淘汰后 `predictor` 变回 None，需要时会重新加载。
+    `users` 为正在使用该预测器的请求数 (由 `lock` 保护)，使用中的模型不会被淘汰。
+    """
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.predictor = None
+        self.fingerprint = None
+        self.size_bytes = 0
+        self.status = {"state": "not_loaded", "error": None, "timings": {}, "persisted_models": []}
+        self.lock = threading.Lock()
+        self.users = 0
+
+
+class CityEntry:
+    """城市 → 特征存储与模型的映射。"""
+
+    def __init__(self, city, features, model):
+        self.city = city
+        self.features = features
+        self.model = model
+
+
+class ModelRegistry:
+    """
+    多城市注册表: 每个城市对应一份特征数据和一个模型目录。
+
+    模型在首次使用时加载，常驻内存的预测器按最近使用顺序 (LRU) 管理，
+    估算的总大小超过 `memory_budget_mb` 时淘汰最久未使用的模型 (至少保留一个；
+    正在被请求使用的模型跳过，在占用结束后再淘汰)。
+    多个城市配置了同一个模型目录时只加载一份。
+
+    `on_load(predictor, timings)` 在每次模型加载成功、对外可见之前调用 (例如为子模型加上计时)。
+    """
+
+    def __init__(self, config, memory_budget_mb=4096, load_fn=None, on_load=None):
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.load_fn = load_fn or _load_tabular_predictor
+        self.on_load = on_load
+        self._lock = threading.Lock()
+        self._resident = OrderedDict()  # model_path -> ModelHandle (最近使用的在末尾)
+        self._models = {}
+        self._stores = {}
+        self._cities = {}
+        for city, settings in config.items():
+            model = self._models.setdefault(settings["model_path"], ModelHandle(settings["model_path"]))
+            # 没有 city 列的数据文件归属于第一个使用它的城市
+            store = self._stores.setdefault(settings["data_path"], FeatureStore(settings["data_path"], default_city=city))
+            self._cities[city] = CityEntry(city, store, model)
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, city):
+        """返回城市对应的 CityEntry，未注册的城市返回 None。"""
+        return self._cities.get(city.lower())
+
+    def cities(self):
+        return sorted(self._cities)
+
+    def models(self):
+        return list(self._models.values())
+
+    def load(self, handle):
+        """加载模型 (同一模型的并发调用只加载一次)，必要时淘汰其他模型。返回是否加载成功。"""
+        with handle.lock:
+            if handle.predictor is not None:
+                self.touch(handle)
+                return True
+            if not os.path.exists(handle.model_path):
+                print(f"错误: 模型目录未找到于 {handle.model_path}")
+                print("请首先通过运行 `python -m ml.train` 来训练模型。")
+                handle.status.update(state="failed", error=f"模型目录未找到于 {handle.model_path}")
+                return False
+
+            handle.status.update(state="loading", error=None)
+            try:
+                predictor, timings, persisted_models = self.load_fn(handle.model_path)
+            except Exception as e:
+                print(f"加载模型 {handle.model_path} 时出错: {e}")
+                handle.status.update(state="failed", error=str(e))
+                return False
+
+            handle.fingerprint = get_model_fingerprint(handle.model_path)
+            handle.size_bytes = _model_size_bytes(handle.model_path, persisted_models)
+            if self.on_load is not None:
+                self.on_load(predictor, timings)
+            handle.predictor = predictor
+            handle.status.update(state="ready", timings=timings, persisted_models=persisted_models)
+            print(f"模型 {handle.model_path} 加载成功 (指纹: {handle.fingerprint})。耗时: {timings}")
+
+        with self._lock:
+            self.loads += 1
+            self._resident[handle.model_path] = handle
+            self._resident.move_to_end(handle.model_path)
+            self._evict(keep=handle)
+        return True
+
+    @contextlib.contextmanager
+    def use(self, handle):
+        """在 with 块内占用模型: 产出其预测器 (未加载时为 None)，占用期间该模型不会被淘汰。"""
+        with handle.lock:
+            predictor = handle.predictor
+            if predictor is not None:
+                handle.users += 1
+        if predictor is None:
+            yield None
+            return
+        self.touch(handle)
+        try:
+            yield predictor
+        finally:
+            with handle.lock:
+                handle.users -= 1
+            # 补上占用期间被跳过的淘汰 (保留最近使用的模型)
+            with self._lock:
+                if self._resident:
+                    self._evict(keep=next(reversed(self._resident.values())))
+
+    def touch(self, handle):
+        """标记模型刚被使用。"""
+        with self._lock:
+            if handle.model_path in self._resident:
+                self._resident.move_to_end(handle.model_path)
+
+    def _evict(self, keep):
+        total = sum(h.size_bytes for h in self._resident.values())
+        for path in list(self._resident):
+            if total <= self.memory_budget:
+                break
+            handle = self._resident[path]
+            # 正在加载或正在被请求使用的模型跳过 (不等待其锁，避免与持有它的线程互相等待)
+            if handle is keep or not handle.lock.acquire(blocking=False):
+                continue
+            try:
+                if handle.users:
+                    continue
+                del self._resident[path]
+                handle.predictor = None
+                handle.status.update(state="evicted", persisted_models=[])
+            finally:
+                handle.lock.release()
+            total -= handle.size_bytes
+            self.evictions += 1
+            print(f"内存预算不足，已淘汰模型 {path}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_budget_mb": round(self.memory_budget / 1024 / 1024, 1),
+                "resident_mb": round(sum(h.size_bytes for h in self._resident.values()) / 1024 / 1024, 1),
+                "resident_models": list(self._resident),
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "cities": {city: entry.model.model_path for city, entry in sorted(self._cities.items())},
+            }
+
+
+def _load_tabular_predictor(model_path):
+    """加载AutoGluon模型，并返回 (预测器, 各阶段耗时, 常驻内存的子模型)。"""
+    start = time.perf_counter()
+    # 延迟导入: 仅导入 autogluon.tabular 就需要数秒，不应阻塞服务启动
+    from autogluon.tabular import TabularPredictor
+    imported = time.perf_counter()
+    predictor = TabularPredictor.load(model_path)
+    unpickled = time.perf_counter()
+    # 只反序列化最终集成实际用到的子模型并让它们常驻内存，
+    # 否则每次 predict 都会从磁盘重新加载所有子模型
+    persisted_models = predictor.persist_models(models='best', with_ancestors=True)
+    persisted = time.perf_counter()
+    timings = {
+        "import_seconds": round(imported - start, 3),
+        "load_seconds": round(unpickled - imported, 3),
+        "persist_seconds": round(persisted - unpickled, 3),
+        "total_seconds": round(persisted - start, 3),
+    }
+    return predictor, timings, persisted_models
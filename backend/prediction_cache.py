@@ -0,0 +1,116 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# 用于计算模型指纹的文件: 元数据内容 + 序列化模型文件的大小/修改时间
+_FINGERPRINT_FILES = ['metadata.json', '__version__', 'deployment.json']
+_FINGERPRINT_STAT_FILES = ['predictor.pkl', 'learner.pkl']
+
+
+def get_model_fingerprint(model_path):
+    """
+    根据模型目录生成一个短指纹。重新训练或替换模型后指纹会改变，
+    从而让旧的预测缓存自动失效。
+    """
+    digest = hashlib.sha1()
+    for name in _FINGERPRINT_FILES:
+        path = os.path.join(model_path, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    for name in _FINGERPRINT_STAT_FILES:
+        path = os.path.join(model_path, name)
+        if os.path.exists(path):
+            st = os.stat(path)
+            digest.update(f"{name}:{st.st_size}:{st.st_mtime_ns}".encode())
+    return digest.hexdigest()[:12]
+
+
+class _InFlight:
+    """一次正在进行中的计算，供并发的相同请求等待其结果。"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class PredictionCache:
+    """
+    有界的预测结果缓存，支持 LRU 淘汰、TTL 过期和 single-flight 去重:
+    同一个键的并发未命中只会触发一次 `compute()`，其余请求等待并共享其结果。
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (过期时间, 值)
+        self._inflight = {}             # key -> _InFlight
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_compute(self, key, compute):
+        """返回键对应的缓存值；未命中时调用 `compute()` 计算并写入缓存。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            call = self._inflight.get(key)
+            if call is not None:
+                # 已有相同的计算在进行，等待它完成即可
+                self.hits += 1
+                leader = False
+            else:
+                call = _InFlight()
+                self._inflight[key] = call
+                self.misses += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = compute()
+        except Exception as e:
+            call.error = e
+            raise
+        else:
+            with self._lock:
+                self._entries[key] = (time.monotonic() + self.ttl, call.value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+            return call.value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            call.done.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,88 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+
+class SamplingProfiler:
+    """
+    进程内采样分析器: 后台线程每隔 `interval_ms` 毫秒记录一次其他所有线程的调用栈，
+    按折叠格式 (collapsed stacks, 每行 "调用栈 次数") 汇总，
+    可直接交给 flamegraph.pl 或 speedscope 生成火焰图。
+
+    只在采样期间有开销 (与线程数成正比)，停止后不影响请求处理。
+    等待队列或锁的空闲线程也会被采样，阅读结果时可按栈顶的函数名过滤。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._stacks = collections.Counter()
+        self.samples = 0
+        self.interval_ms = None
+        self.started_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval_ms=5.0):
+        """开始采样 (清空之前的结果)。已在运行时返回 False。"""
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self._stacks = collections.Counter()
+            self.samples = 0
+            self.interval_ms = interval_ms
+            self.started_at = time.time()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval_ms / 1000,), name='sampling-profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        """停止采样并返回折叠格式的结果。"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+        return self.collapsed()
+
+    def collapsed(self):
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks)
+
+    def status(self):
+        return {
+            "running": self.running,
+            "interval_ms": self.interval_ms,
+            "started_at": self.started_at,
+            "samples": self.samples,
+            "distinct_stacks": len(self._stacks),
+        }
+
+    def _run(self, interval):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(interval):
+            sampled = collections.Counter()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    key = (code.co_filename, code.co_name)
+                    name = names.get(key)
+                    if name is None:
+                        name = names[key] = f'{code.co_name} ({os.path.basename(code.co_filename)})'
+                    stack.append(name)
+                    frame = frame.f_back
+                sampled[';'.join(reversed(stack))] += 1
+            with self._lock:
+                self._stacks.update(sampled)
+                self.samples += 1
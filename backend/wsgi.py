@@ -0,0 +1,29 @@
+"""
+生产环境入口:
+
+    gunicorn -c backend/gunicorn.conf.py backend.wsgi:app
+
+gunicorn 以 `preload_app` 方式在主进程中导入本模块: 默认模型和特征数据在 fork 之前
+加载一次，之后各 worker 进程以写时复制 (copy-on-write) 的方式共享这些只读内存页，
+而不是每个 worker 各自加载一份 AutoGluon 集成模型。
+"""
+import gc
+
+from backend import app as server
+
+# 在 fork 之前同步加载默认模型 (与 AQI_MODEL_LOAD_MODE 无关)，并预读其特征数据。
+# 注意不要在这里调用 predict: 推理会启动 OpenMP 等本地线程池，它们在 fork 之后不可用。
+server.load_model()
+entry = server.registry.get(server.DEFAULT_CITY)
+if entry is not None:
+    try:
+        entry.features.refresh()
+    except FileNotFoundError:
+        print(f"数据文件未找到于 {entry.features.data_path}")
+
+# 把目前所有对象移出垃圾回收的跟踪范围，避免 worker 中的 GC 修改引用计数/GC 头
+# 而触发大量页面复制，使共享内存失效
+gc.collect()
+gc.freeze()
+
+app = server.app
@@ -0,0 +1,294 @@
+"""
+Latency and throughput benchmark for the prediction path.
+
+Measures each stage of a prediction by calling the underlying functions directly
+(data load, feature build, model inference, AQI category, JSON response), then drives
+`/api/predict/<city>` through Flask's test client at several concurrency levels.
+Results are written as JSON and optionally compared against a baseline run:
+
+    python -m benchmarks.bench_predict --output benchmarks/results.json
+    python -m benchmarks.bench_predict --baseline benchmarks/baseline.json
+
+The exit code is 1 when any metric regressed by more than `--tolerance`.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Only the stages under test should do work: no background model loading
+os.environ.setdefault('AQI_MODEL_LOAD_MODE', 'lazy')
+
+from backend import app as server
+from backend.feature_store import FEATURE_COLUMNS, WINDOW_DAYS, FeatureStore, build_feature_row
+from backend.prediction_cache import PredictionCache
+from ml.aqi import get_aqi_category
+
+DEFAULT_OUTPUT = os.path.join('benchmarks', 'results.json')
+DEFAULT_CONCURRENCY = [1, 4, 16]
+PERCENTILES = (50, 95, 99)
+
+
+class NullModel:
+    """Constant predictor, used to measure the serving overhead without a trained model."""
+
+    def features(self):
+        return FEATURE_COLUMNS
+
+    def predict(self, input_df):
+        return pd.Series(np.full(len(input_df), 42.0), index=input_df.index)
+
+
+class NoCache:
+    """
+    Stands in for `PredictionCache` in the uncached runs: every request computes its
+    prediction. (A cache with `maxsize=0` would still single-flight concurrent requests
+    for the same key, so they would share one prediction.)
+    """
+
+    def get_or_compute(self, key, compute):
+        return compute()
+
+    def stats(self):
+        return {"size": 0, "maxsize": 0, "ttl": 0, "hits": 0, "misses": 0, "evictions": 0}
+
+
+def summarize(seconds):
+    """Latency summary (milliseconds) of a list of durations in seconds."""
+    ms = np.asarray(seconds) * 1000
+    summary = {'n': int(len(ms)), 'mean_ms': round(float(ms.mean()), 4)}
+    for p in PERCENTILES:
+        summary[f'p{p}_ms'] = round(float(np.percentile(ms, p)), 4)
+    summary['max_ms'] = round(float(ms.max()), 4)
+    return summary
+
+
+def time_calls(fn, iterations, warmup=5):
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def _prepare_model(city, null_model):
+    entry = server.registry.get(city)
+    if entry is None:
+        raise SystemExit(f"{city} is not in the city registry")
+    handle = entry.model
+    if null_model:
+        handle.predictor = NullModel()
+        handle.fingerprint = 'null-model'
+        handle.status.update(state="ready")
+    elif not server.registry.load(handle):
+        raise SystemExit(f"Could not load the model at {handle.model_path}: {handle.status['error']} "
+                         "(use --null-model to benchmark without a trained model)")
+    return entry, handle.predictor
+
+
+def benchmark_stages(city, iterations, batch_rows, null_model):
+    """Times each stage of a prediction by calling it directly."""
+    entry, model = _prepare_model(city, null_model)
+    store = entry.features
+    history = store.history(city)
+    if history is None:
+        raise SystemExit(f"No data for {city} in {store.data_path}")
+
+    input_df, _ = build_feature_row(history.tail(WINDOW_DAYS))
+    input_df = input_df[model.features()]
+    batch_df, _, _ = store.build_batch([(city, None)] * batch_rows)
+    batch_df = batch_df[model.features()]
+    aqi = int(model.predict(input_df).iloc[0])
+
+    def load_data():
+        with contextlib.redirect_stdout(io.StringIO()):  # the store logs every full load
+            FeatureStore(store.data_path).refresh()
+
+    def respond():
+        with server.app.app_context():
+            server.jsonify(server.build_prediction_response(city, aqi)).get_data()
+
+    stages = {
+        # Cold load of the data file into a new feature store (the "CSV read")
+        'data_load': time_calls(load_data, min(iterations, 50), warmup=1),
+        # Per-request check that the data file has not changed
+        'data_refresh': time_calls(store.refresh, iterations),
+        'feature_build': time_calls(lambda: build_feature_row(history.tail(WINDOW_DAYS)), iterations),
+        'feature_batch': time_calls(lambda: store.build_batch([(city, None)] * batch_rows), iterations),
+        'predict': time_calls(lambda: model.predict(input_df), iterations),
+        'predict_batch': time_calls(lambda: model.predict(batch_df), iterations),
+        'aqi_category': time_calls(lambda: get_aqi_category(aqi), iterations),
+        'response_json': time_calls(respond, iterations),
+    }
+    result = {name: summarize(durations) for name, durations in stages.items()}
+    result['predict_batch']['rows'] = batch_rows
+    return result
+
+
+def benchmark_endpoint(city, requests_per_level, concurrency_levels, cached):
+    """Drives `/api/predict/<city>` through the test client at each concurrency level."""
+    # Without the cache every request runs the full path: feature lookup, scheduler, predict
+    original_cache = server.prediction_cache
+    server.prediction_cache = PredictionCache() if cached else NoCache()
+    try:
+        return _drive_endpoint(f'/api/predict/{city}', requests_per_level, concurrency_levels)
+    finally:
+        server.prediction_cache = original_cache
+
+
+def _drive_endpoint(url, requests_per_level, concurrency_levels):
+    server.app.test_client().get(url)  # warm-up
+
+    results = {}
+    for concurrency in concurrency_levels:
+        per_worker = max(1, requests_per_level // concurrency)
+
+        def worker(_):
+            client = server.app.test_client()
+            durations = []
+            for _ in range(per_worker):
+                start = time.perf_counter()
+                response = client.get(url)
+                durations.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    raise RuntimeError(f"{url} returned {response.status_code}: {response.get_json()}")
+            return durations
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            durations = [d for worker_durations in pool.map(worker, range(concurrency)) for d in worker_durations]
+        wall = time.perf_counter() - start
+        summary = summarize(durations)
+        summary['concurrency'] = concurrency
+        summary['rps'] = round(len(durations) / wall, 2)
+        results[f'concurrency_{concurrency}'] = summary
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(city='chicago', iterations=200, batch_rows=64, requests_per_level=400,
+                  concurrency_levels=DEFAULT_CONCURRENCY, null_model=False):
+    """Runs all benchmarks and returns the results as a JSON-serializable dict."""
+    stages = benchmark_stages(city, iterations, batch_rows, null_model)
+    endpoint = {
+        'uncached': benchmark_endpoint(city, requests_per_level, concurrency_levels, cached=False),
+        'cached': benchmark_endpoint(city, requests_per_level, concurrency_levels, cached=True),
+    }
+    return {
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'git_commit': _git_commit(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'model': 'null' if null_model else server.registry.get(city).model.model_path,
+            'data_path': server.registry.get(city).features.data_path,
+            'city': city,
+        },
+        'stages': stages,
+        'endpoint': endpoint,
+    }
+
+
+def _metrics(results):
+    """Flattens results into {metric name: (value, higher_is_better)}."""
+    metrics = {}
+    for stage, summary in results.get('stages', {}).items():
+        for p in PERCENTILES:
+            metrics[f'stages.{stage}.p{p}_ms'] = (summary[f'p{p}_ms'], False)
+    for mode, levels in results.get('endpoint', {}).items():
+        for level, summary in levels.items():
+            for p in PERCENTILES:
+                metrics[f'endpoint.{mode}.{level}.p{p}_ms'] = (summary[f'p{p}_ms'], False)
+            metrics[f'endpoint.{mode}.{level}.rps'] = (summary['rps'], True)
+    return metrics
+
+
+def compare(results, baseline, tolerance=0.2, min_delta_ms=0.05):
+    """
+    Compares every metric with the baseline. Returns a list of
+    (metric, baseline value, current value, relative change, regressed).
+
+    Latencies only count as regressed if they also grew by more than `min_delta_ms`,
+    so timer noise on microsecond-scale stages is not reported.
+    """
+    current = _metrics(results)
+    rows = []
+    for name, (base_value, higher_is_better) in _metrics(baseline).items():
+        if name not in current or not base_value:
+            continue
+        value = current[name][0]
+        change = (value - base_value) / base_value
+        if higher_is_better:
+            regressed = change < -tolerance
+        else:
+            regressed = change > tolerance and value - base_value > min_delta_ms
+        rows.append((name, base_value, value, change, regressed))
+    return rows
+
+
+def _print_results(results):
+    print(f"\n{'stage':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, s in results['stages'].items():
+        print(f"{stage:<16}{s['p50_ms']:>10.3f}{s['p95_ms']:>10.3f}{s['p99_ms']:>10.3f}")
+    for mode, levels in results['endpoint'].items():
+        print(f"\n/api/predict ({mode})")
+        print(f"{'concurrency':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}")
+        for s in levels.values():
+            print(f"{s['concurrency']:<16}{s['p50_ms']:>10.3f}{s['p95_ms']:>10.3f}{s['p99_ms']:>10.3f}{s['rps']:>10.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the prediction path.")
+    parser.add_argument('--city', default='chicago')
+    parser.add_argument('--iterations', type=int, default=200, help="calls per stage")
+    parser.add_argument('--batch-rows', type=int, default=64, help="rows in the batch feature/predict stages")
+    parser.add_argument('--requests', type=int, default=400, help="endpoint requests per concurrency level")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--null-model', action='store_true',
+                        help="use a constant predictor to measure the serving overhead only")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', help="results JSON of a previous run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="relative change counted as a regression (default 0.2 = 20%%)")
+    parser.add_argument('--min-delta-ms', type=float, default=0.05,
+                        help="ignore latency increases smaller than this (milliseconds)")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.city, args.iterations, args.batch_rows, args.requests,
+                            args.concurrency, args.null_model)
+    _print_results(results)
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            rows = compare(results, json.load(f), args.tolerance, args.min_delta_ms)
+        regressions = [row for row in rows if row[4]]
+        print(f"\nCompared {len(rows)} metrics with {args.baseline}: {len(regressions)} regression(s)")
+        for name, base_value, value, change, _ in regressions:
+            print(f"  {name}: {base_value:.3f} -> {value:.3f} ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
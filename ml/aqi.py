@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 def _linear(aqi_high, aqi_low, conc_high, conc_low, concentration):
     """一个通用的线性插值函数，用于计算AQI值。"""
@@ -49,6 +50,16 @@ def _calculate_o3_aqi(concentration_ppb):
     else:
         return 301
 
+# (category, health advice, image level code), ordered from best to worst
+AQI_CATEGORIES = (
+    ("Good", "Air quality is considered satisfactory, and air pollution poses little or no risk.", "good"),
+    ("Moderate", "Air quality is acceptable; however, for some pollutants there may be a moderate health concern for a very small number of people who are unusually sensitive to air pollution.", "moderate"),
+    ("Unhealthy for Sensitive Groups", "Members of sensitive groups may experience health effects. The general public is not likely to be affected.", "unhealthy"),
+    ("Unhealthy", "Everyone may begin to experience health effects; members of sensitive groups may experience more serious health effects.", "unhealthy"),
+    ("Very Unhealthy", "Health alert: everyone may experience more serious health effects.", "unhealthy"),
+    ("Hazardous", "Health warnings of emergency conditions. The entire population is more likely to be affected.", "unhealthy"),
+)
+
 def get_overall_aqi(pm25_conc, o3_conc_ppb):
     """
     Calculates the overall AQI by taking the maximum of individual pollutant AQIs.
@@ -73,17 +84,202 @@ def get_aqi_category(aqi):
     Returns the AQI category and health recommendations based on the AQI value.
     """
     if 0 <= aqi <= 50:
-        return ("Good", "Air quality is considered satisfactory, and air pollution poses little or no risk.", "good")
+        return AQI_CATEGORIES[0]
     elif 51 <= aqi <= 100:
-        return ("Moderate", "Air quality is acceptable; however, for some pollutants there may be a moderate health concern for a very small number of people who are unusually sensitive to air pollution.", "moderate")
+        return AQI_CATEGORIES[1]
     elif 101 <= aqi <= 150:
-        return ("Unhealthy for Sensitive Groups", "Members of sensitive groups may experience health effects. The general public is not likely to be affected.", "unhealthy")
+        return AQI_CATEGORIES[2]
     elif 151 <= aqi <= 200:
-        return ("Unhealthy", "Everyone may begin to experience health effects; members of sensitive groups may experience more serious health effects.", "unhealthy")
+        return AQI_CATEGORIES[3]
     elif 201 <= aqi <= 300:
-        return ("Very Unhealthy", "Health alert: everyone may experience more serious health effects.", "unhealthy")
+        return AQI_CATEGORIES[4]
     else: # aqi >= 301
-        return ("Hazardous", "Health warnings of emergency conditions. The entire population is more likely to be affected.", "unhealthy")
+        return AQI_CATEGORIES[5]
+
+# --- Vectorized, table-driven AQI engine ---
+# The breakpoint tables below cover every EPA AQI pollutant. Lookup structures are
+# precomputed once at import time, and `compute_aqi` evaluates any subset of the
+# pollutant columns in one vectorized pass. For PM2.5 and 8-hour ozone the results
+# are identical to the scalar functions above, including truncation and the 501/301 caps.
+#
+# Reference: https://www.airnow.gov/sites/default/files/2020-05/aqi-technical-assistance-document-sept2018.pdf
+# Units: PM2.5/PM10 in µg/m³, CO in ppm, O3/SO2/NO2 in ppb.
+
+# Marks a pollutant (or a row) without a valid concentration
+MISSING_AQI = -1
+
+# pollutant key -> (display name, truncation decimals, AQI above the top band,
+#                   AQI below the first band (None: same as above the top band),
+#                   [(concentration low, concentration high, AQI low, AQI high), ...])
+# The key order defines the dominant pollutant codes; ties go to the earlier pollutant.
+AQI_BREAKPOINT_TABLES = {
+    'pm25': ("PM2.5", 1, 501, None, [
+        (0.0, 12.0, 0, 50),
+        (12.1, 35.4, 51, 100),
+        (35.5, 55.4, 101, 150),
+        (55.5, 150.4, 151, 200),
+        (150.5, 250.4, 201, 300),
+        (250.5, 350.4, 301, 400),
+        (350.5, 500.4, 401, 500),
+    ]),
+    # 8-hour ozone; above 200 ppb the 1-hour breakpoints apply instead
+    'o3': ("Ozone", 0, 301, None, [
+        (0, 54, 0, 50),
+        (55, 70, 51, 100),
+        (71, 85, 101, 150),
+        (86, 105, 151, 200),
+        (106, 200, 201, 300),
+    ]),
+    # 1-hour ozone only defines AQI values from 101 upwards
+    'o3_1h': ("Ozone", 0, 501, 0, [
+        (125, 164, 101, 150),
+        (165, 204, 151, 200),
+        (205, 404, 201, 300),
+        (405, 504, 301, 400),
+        (505, 604, 401, 500),
+    ]),
+    'pm10': ("PM10", 0, 501, None, [
+        (0, 54, 0, 50),
+        (55, 154, 51, 100),
+        (155, 254, 101, 150),
+        (255, 354, 151, 200),
+        (355, 424, 201, 300),
+        (425, 504, 301, 400),
+        (505, 604, 401, 500),
+    ]),
+    'co': ("CO", 1, 501, None, [
+        (0.0, 4.4, 0, 50),
+        (4.5, 9.4, 51, 100),
+        (9.5, 12.4, 101, 150),
+        (12.5, 15.4, 151, 200),
+        (15.5, 30.4, 201, 300),
+        (30.5, 40.4, 301, 400),
+        (40.5, 50.4, 401, 500),
+    ]),
+    'so2': ("SO2", 0, 501, None, [
+        (0, 35, 0, 50),
+        (36, 75, 51, 100),
+        (76, 185, 101, 150),
+        (186, 304, 151, 200),
+        (305, 604, 201, 300),
+        (605, 804, 301, 400),
+        (805, 1004, 401, 500),
+    ]),
+    'no2': ("NO2", 0, 501, None, [
+        (0, 53, 0, 50),
+        (54, 100, 51, 100),
+        (101, 360, 101, 150),
+        (361, 649, 151, 200),
+        (650, 1249, 201, 300),
+        (1250, 1649, 301, 400),
+        (1650, 2049, 401, 500),
+    ]),
+}
+
+POLLUTANTS = tuple(AQI_BREAKPOINT_TABLES)
+# Concentration unit of each breakpoint table
+POLLUTANT_UNITS = {
+    'pm25': 'µg/m³',
+    'o3': 'ppb',
+    'o3_1h': 'ppb',
+    'pm10': 'µg/m³',
+    'co': 'ppm',
+    'so2': 'ppb',
+    'no2': 'ppb',
+}
+# Display names for the dominant pollutant codes returned by `compute_aqi`
+POLLUTANT_NAMES = tuple(table[0] for table in AQI_BREAKPOINT_TABLES.values())
+
+
+class _BreakpointLookup:
+    """Precomputed arrays for one pollutant's breakpoint table."""
+
+    def __init__(self, decimals, cap, below, bands):
+        bands = np.array(bands, dtype=float)
+        self.factor = 10 ** decimals
+        self.cap = cap
+        self.below = cap if below is None else below
+        self.conc_low = bands[:, 0]
+        self.conc_high = bands[:, 1]
+        self.conc_span = bands[:, 1] - bands[:, 0]
+        self.aqi_low = bands[:, 2]
+        self.aqi_span = bands[:, 3] - bands[:, 2]
+
+    def __call__(self, concentration):
+        c = np.floor(np.asarray(concentration, dtype=float) * self.factor) / self.factor
+        band = np.searchsorted(self.conc_low, c, side='right') - 1
+        below = band < 0
+        band = np.clip(band, 0, None)
+        in_band = ~below & (c <= self.conc_high[band])
+        aqi = ((c - self.conc_low[band]) / self.conc_span[band]) * self.aqi_span[band] + self.aqi_low[band]
+        aqi = np.where(in_band, np.round(aqi), np.where(below, self.below, self.cap))
+        return np.where(np.isnan(c), MISSING_AQI, aqi).astype(np.int64)
+
+
+_LOOKUPS = {
+    key: _BreakpointLookup(decimals, cap, below, bands)
+    for key, (_, decimals, cap, below, bands) in AQI_BREAKPOINT_TABLES.items()
+}
+# AQI range of each category band; anything outside all bands is "Hazardous"
+_CATEGORY_BOUNDS = np.array([(0, 50), (51, 100), (101, 150), (151, 200), (201, 300)])
+
+
+def compute_aqi(concentrations, pollutants=None):
+    """
+    Computes the overall AQI and the dominant pollutant for many rows at once.
+
+    Args:
+        concentrations (DataFrame or dict): Columns of concentrations keyed by pollutant
+            (any subset of `POLLUTANTS`); other columns are ignored. NaN marks a missing
+            reading, which is skipped for that row.
+        pollutants (list, optional): Restricts the calculation to these pollutants.
+
+    Returns:
+        tuple: An int64 array of AQI values (`MISSING_AQI` where no pollutant is available)
+        and a uint8 array of dominant pollutant codes (indices into `POLLUTANTS`/`POLLUTANT_NAMES`).
+    """
+    keys = [key for key in POLLUTANTS
+            if key in concentrations and (pollutants is None or key in pollutants)]
+    if not keys:
+        raise ValueError(f"No supported pollutant columns found; expected any of {POLLUTANTS}")
+
+    per_pollutant = np.stack([_LOOKUPS[key](concentrations[key]) for key in keys])
+    # argmax picks the first maximum, so ties go to the pollutant listed first
+    dominant_index = per_pollutant.argmax(axis=0)
+    codes = np.array([POLLUTANTS.index(key) for key in keys], dtype=np.uint8)
+    return per_pollutant.max(axis=0), codes[dominant_index]
+
+
+def get_overall_aqi_array(pm25_conc, o3_conc_ppb):
+    """
+    Array version of `get_overall_aqi`.
+
+    Args:
+        pm25_conc (array-like): PM2.5 concentrations in µg/m³.
+        o3_conc_ppb (array-like): Ozone concentrations in ppb.
+
+    Returns:
+        tuple: An int64 array of AQI values and a uint8 array of dominant pollutant
+        codes (indices into `POLLUTANT_NAMES`).
+    """
+    pm25_conc = np.asarray(pm25_conc, dtype=float)
+    o3_conc_ppb = np.asarray(o3_conc_ppb, dtype=float)
+    if np.isnan(pm25_conc).any() or np.isnan(o3_conc_ppb).any():
+        raise ValueError("cannot convert float NaN to integer")
+    return compute_aqi({'pm25': pm25_conc, 'o3': o3_conc_ppb})
+
+
+def get_aqi_category_array(aqi):
+    """
+    Array version of `get_aqi_category`.
+
+    Returns:
+        numpy.ndarray: uint8 category codes, i.e. indices into `AQI_CATEGORIES`.
+    """
+    values = np.asarray(aqi)[..., np.newaxis]
+    in_band = (_CATEGORY_BOUNDS[:, 0] <= values) & (values <= _CATEGORY_BOUNDS[:, 1])
+    # argmax returns the first matching band; rows with no match fall back to "Hazardous"
+    return np.where(in_band.any(axis=-1), in_band.argmax(axis=-1), len(AQI_CATEGORIES) - 1).astype(np.uint8)
 
 if __name__ == '__main__':
     # Example usage:
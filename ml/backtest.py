@@ -0,0 +1,306 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from ml.aqi import get_aqi_category_array
+from ml.storage import DATA_DIR, DATASET_PATH, DEFAULT_CITY, read_final_data
+from ml.train import (DEPLOY_MODEL_PATH, TABULAR_MODEL_PATH, TARGET, VALIDATION_PERIOD, build_training_frame,
+                      load_training_cutoffs)
+from ml.train_timeseries import TIMESERIES_MODEL_PATH, load_aqi_series
+
+BACKTEST_PATH = os.path.join(DATA_DIR, 'backtest.csv')
+DEFAULT_FOLDS = 8
+DEFAULT_HORIZON = 7   # days scored after each forecast origin
+DEFAULT_STEP = 7      # days between consecutive origins
+MIN_HISTORY = 14      # days of data required before the first origin
+
+# The backend serves the deployment model when it has been exported
+SERVED_MODEL_PATH = DEPLOY_MODEL_PATH if os.path.exists(DEPLOY_MODEL_PATH) else TABULAR_MODEL_PATH
+
+
+def forecast_origins(dates, folds=DEFAULT_FOLDS, horizon=DEFAULT_HORIZON, step=DEFAULT_STEP,
+                     min_history=MIN_HISTORY):
+    """
+    The last day of data seen at each forecast origin, oldest first. The newest origin
+    leaves `horizon` days to score; earlier ones are `step` days apart.
+    """
+    dates = pd.to_datetime(pd.Series(dates))
+    first, last = dates.min(), dates.max()
+    day = pd.Timedelta(days=1)
+    origins = [last - horizon * day - i * step * day for i in range(folds)]
+    return sorted(o for o in origins if o >= first + (min_history - 1) * day)
+
+
+def training_cutoffs(model_path, scored_dates):
+    """
+    The last target date per city that the model at `model_path` was fit on. Models
+    trained before cutoffs were recorded are assumed to have been fit on `scored_dates`
+    (a frame of `city` and `date`) minus the last `VALIDATION_PERIOD` days of each city,
+    the split used by the training scripts.
+    """
+    cutoffs = load_training_cutoffs(model_path)
+    if cutoffs is not None:
+        return cutoffs
+    print(f"Warning: {model_path} has no recorded training cutoff; assuming it was fit on the "
+          f"current data except the last {VALIDATION_PERIOD} days of each city")
+    scored_dates = scored_dates.sort_values('date')
+    trained = scored_dates.groupby('city').cumcount(ascending=False) >= VALIDATION_PERIOD
+    return scored_dates[trained].groupby('city')['date'].max().to_dict()
+
+
+def _flag_in_sample(scored, cutoffs):
+    """Marks the scored days whose target the model was fit on."""
+    cutoff = pd.to_datetime(scored['city'].map(cutoffs))
+    return scored.assign(in_sample=scored['date'] <= cutoff)
+
+
+# --- Worker processes ---
+# Each worker loads the predictor once and predicts whole chunks of folds in single calls
+
+_PREDICTOR = None
+
+
+def _load_predictor(kind, model_path):
+    if kind == 'tabular':
+        from autogluon.tabular import TabularPredictor
+        return TabularPredictor.load(model_path)
+    from autogluon.timeseries import TimeSeriesPredictor
+    return TimeSeriesPredictor.load(model_path)
+
+
+def _init_worker(kind, model_path):
+    global _PREDICTOR
+    _PREDICTOR = _load_predictor(kind, model_path)
+
+
+def _predict_tabular(rows):
+    """Next-day AQI of every feature row (one `predict` call)."""
+    return _PREDICTOR.predict(rows).to_numpy()
+
+
+def _predict_timeseries(context):
+    """Mean forecast of every (series, origin) item in `context` (one `predict` call)."""
+    from autogluon.timeseries import TimeSeriesDataFrame
+    forecast = _PREDICTOR.predict(TimeSeriesDataFrame(context))
+    return pd.DataFrame(forecast)['mean'].reset_index()
+
+
+def _run_chunks(kind, model_path, predict_fn, chunks, workers):
+    """Runs `predict_fn` over the chunks, in this process or on `workers` processes."""
+    if workers <= 1 or len(chunks) <= 1:
+        _init_worker(kind, model_path)
+        return [predict_fn(chunk) for chunk in chunks]
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), initializer=_init_worker,
+                             initargs=(kind, model_path)) as pool:
+        return list(pool.map(predict_fn, chunks))
+
+
+def _origin_chunks(origins, workers):
+    return [list(chunk) for chunk in np.array_split(np.asarray(origins, dtype=object), max(1, workers)) if len(chunk)]
+
+
+# --- Backtests ---
+
+def backtest_tabular(df, origins, horizon=DEFAULT_HORIZON, model_path=SERVED_MODEL_PATH, workers=1):
+    """
+    Scores the served next-day model at each origin on the `horizon` days that follow it.
+
+    Every day is predicted from the previous day's row of `build_training_frame`, i.e. the
+    features the model was trained on. Serving builds its rows differently (the calendar
+    features of the predicted day and its own rolling means in `backend.feature_store`),
+    so the scores measure the model, not the serving feature path.
+    The rows of all folds in a chunk are predicted with one `predict` call.
+
+    Returns:
+        DataFrame: One row per scored day (`origin`, `city`, `date`, `actual`, `predicted`,
+        `in_sample`: whether the model was fit on that day's target), and the seconds
+        spent predicting.
+    """
+    df = df.copy()
+    df['date'] = pd.to_datetime(df['date'])
+    if 'city' not in df.columns:
+        df['city'] = DEFAULT_CITY
+    # A feature row of day d is scored against the AQI of the city's next row (`target_date`)
+    frame, features = build_training_frame(df)
+
+    horizon_days = pd.Timedelta(days=horizon)
+    folds = []
+    for origin in origins:
+        in_window = (frame['target_date'] > origin) & (frame['target_date'] <= origin + horizon_days)
+        folds.append(frame.loc[in_window, ['city', 'target_date', TARGET]].assign(origin=origin))
+    scored = pd.concat(folds)
+
+    # Overlapping windows share rows; each row is predicted once per chunk
+    chunks, chunk_indexes = [], []
+    for chunk_origins in _origin_chunks(origins, workers):
+        index = scored.index[scored['origin'].isin(chunk_origins)].unique()
+        chunks.append(frame.loc[index, features])
+        chunk_indexes.append(index)
+    start = time.perf_counter()
+    results = _run_chunks('tabular', model_path, _predict_tabular, chunks, workers)
+    seconds = time.perf_counter() - start
+
+    predictions = pd.concat([pd.Series(values, index=index) for values, index in zip(results, chunk_indexes)])
+    predictions = predictions[~predictions.index.duplicated()]
+    # The backend truncates the predicted AQI to an integer
+    scored['predicted'] = predictions.loc[scored.index].to_numpy().astype(int)
+    scored = scored.rename(columns={'target_date': 'date', TARGET: 'actual'})
+    cutoffs = training_cutoffs(model_path, frame[['city', 'target_date']].rename(columns={'target_date': 'date'}))
+    scored = _flag_in_sample(scored, cutoffs)
+    return scored[['origin', 'city', 'date', 'actual', 'predicted', 'in_sample']].reset_index(drop=True), seconds
+
+
+def backtest_timeseries(df, origins, horizon=DEFAULT_HORIZON, model_path=TIMESERIES_MODEL_PATH, workers=1):
+    """
+    Scores the time series model's forecasts from each origin over the following
+    `horizon` days (at most its prediction length).
+
+    Each (city, origin) pair becomes one truncated series, so the forecasts of all
+    origins in a chunk come from one `predict` call.
+
+    Returns:
+        DataFrame: One row per scored day (`origin`, `city`, `date`, `actual`, `predicted`,
+        `in_sample`: whether the model was fit on that day), and the seconds spent predicting.
+    """
+    series = pd.DataFrame(load_aqi_series(df)).reset_index()
+    horizon_days = pd.Timedelta(days=horizon)
+    contexts, actuals = [], []
+    for origin in origins:
+        item_id = series['item_id'] + '@' + origin.strftime('%Y-%m-%d')
+        seen = series['timestamp'] <= origin
+        contexts.append(series[seen].assign(item_id=item_id[seen], origin=origin))
+        future = ~seen & (series['timestamp'] <= origin + horizon_days)
+        actuals.append(series[future].assign(origin=origin))
+    context = pd.concat(contexts, ignore_index=True)
+    actual = pd.concat(actuals, ignore_index=True)
+
+    chunks = [context[context['origin'].isin(chunk_origins)].drop(columns='origin')
+              for chunk_origins in _origin_chunks(origins, workers)]
+    start = time.perf_counter()
+    results = _run_chunks('timeseries', model_path, _predict_timeseries, chunks, workers)
+    seconds = time.perf_counter() - start
+
+    forecast = pd.concat(results, ignore_index=True)
+    split = forecast['item_id'].str.rsplit('@', n=1, expand=True)
+    forecast = forecast.assign(item_id=split[0], origin=pd.to_datetime(split[1]))
+    scored = actual.merge(forecast, on=['item_id', 'origin', 'timestamp'], how='inner')
+    # The forecast table served by the backend rounds and clips at zero
+    scored['predicted'] = scored['mean'].round().clip(lower=0).astype(int)
+    scored = scored.rename(columns={'item_id': 'city', 'timestamp': 'date', 'aqi': 'actual'})
+    scored['city'] = scored['city'].str.lower()
+    cutoffs = training_cutoffs(model_path, series.assign(city=series['item_id'].str.lower(), date=series['timestamp']))
+    scored = _flag_in_sample(scored, cutoffs)
+    return scored[['origin', 'city', 'date', 'actual', 'predicted', 'in_sample']], seconds
+
+
+def window_in_sample(scored):
+    """Per scored day, whether its origin's window holds any day the model was fit on."""
+    return scored.groupby('origin')['in_sample'].transform('any')
+
+
+def score_windows(scored, horizon=DEFAULT_HORIZON):
+    """
+    RMSE and AQI-category accuracy of each origin's window. A window is `in_sample` if
+    the model was fit on any of its days.
+    """
+    scored = scored.assign(
+        squared_error=(scored['predicted'] - scored['actual']) ** 2,
+        category_hit=get_aqi_category_array(scored['predicted'].to_numpy())
+        == get_aqi_category_array(scored['actual'].to_numpy()),
+    )
+    windows = scored.groupby('origin').agg(
+        rows=('actual', 'size'),
+        rmse=('squared_error', 'mean'),
+        category_accuracy=('category_hit', 'mean'),
+        in_sample=('in_sample', 'any'),
+    ).reset_index()
+    windows['rmse'] = np.sqrt(windows['rmse'])
+    windows.insert(1, 'window_start', windows['origin'] + pd.Timedelta(days=1))
+    windows.insert(2, 'window_end', windows['origin'] + pd.Timedelta(days=horizon))
+    return windows
+
+
+def run_backtest(df, models=('tabular', 'timeseries'), folds=DEFAULT_FOLDS, horizon=DEFAULT_HORIZON,
+                 step=DEFAULT_STEP, workers=1, tabular_model_path=SERVED_MODEL_PATH,
+                 timeseries_model_path=TIMESERIES_MODEL_PATH):
+    """
+    Walk-forward backtest of the selected models over the same origins.
+
+    Windows that overlap a model's training data flatter it, so each model is summarized
+    separately over its out-of-sample and in-sample windows.
+
+    Returns:
+        tuple: The per-window scores of every model (with a `model` column) and a
+        per-model, per-sample summary with the RMSE, category accuracy and runtime.
+    """
+    origins = forecast_origins(df['date'], folds, horizon, step)
+    if not origins:
+        raise ValueError(f"Not enough data for a {horizon}-day window after {MIN_HISTORY} days of history")
+    print(f"Backtesting {len(origins)} origins from {origins[0].date()} to {origins[-1].date()}, "
+          f"{horizon}-day windows")
+
+    backtests = {
+        'tabular': lambda: backtest_tabular(df, origins, horizon, tabular_model_path, workers),
+        'timeseries': lambda: backtest_timeseries(df, origins, horizon, timeseries_model_path, workers),
+    }
+    windows, summary = [], []
+    for model in models:
+        start = time.perf_counter()
+        scored, predict_seconds = backtests[model]()
+        total_seconds = time.perf_counter() - start
+        model_windows = score_windows(scored, horizon)
+        windows.append(model_windows.assign(model=model))
+        scored = scored.assign(window_in_sample=window_in_sample(scored))
+        for in_sample, group in scored.groupby('window_in_sample', sort=True):
+            hits = get_aqi_category_array(group['predicted'].to_numpy()) == get_aqi_category_array(group['actual'].to_numpy())
+            summary.append({
+                'model': model,
+                'sample': 'in_sample' if in_sample else 'out_of_sample',
+                'origins': group['origin'].nunique(),
+                'rows': len(group),
+                'rmse': float(np.sqrt(((group['predicted'] - group['actual']) ** 2).mean())),
+                'category_accuracy': float(hits.mean()),
+                'predict_seconds': round(predict_seconds, 3),
+                'total_seconds': round(total_seconds, 3),
+            })
+        if not (~model_windows['in_sample']).any():
+            print(f"Warning: every {model} window overlaps its training data; "
+                  "there is no out-of-sample score")
+
+    windows = pd.concat(windows, ignore_index=True)
+    windows = windows[['model'] + [c for c in windows.columns if c != 'model']]
+    return windows, pd.DataFrame(summary)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Walk-forward backtest of the tabular and time series models.")
+    parser.add_argument('--models', nargs='+', choices=['tabular', 'timeseries'], default=['tabular', 'timeseries'])
+    parser.add_argument('--folds', type=int, default=DEFAULT_FOLDS, help="number of forecast origins")
+    parser.add_argument('--horizon', type=int, default=DEFAULT_HORIZON, help="days scored after each origin")
+    parser.add_argument('--step', type=int, default=DEFAULT_STEP, help="days between origins")
+    parser.add_argument('--workers', type=int, default=1, help="processes predicting chunks of folds in parallel")
+    parser.add_argument('--tabular-model', default=SERVED_MODEL_PATH)
+    parser.add_argument('--timeseries-model', default=TIMESERIES_MODEL_PATH)
+    parser.add_argument('--output', default=BACKTEST_PATH)
+    args = parser.parse_args()
+
+    try:
+        data = read_final_data(include_city=True)
+    except FileNotFoundError:
+        print(f"Error: Processed data not found at {DATASET_PATH}")
+        print("Please run `python -m ml.prepare_data` first.")
+        raise SystemExit(1)
+
+    window_scores, model_summary = run_backtest(data, args.models, args.folds, args.horizon, args.step,
+                                                args.workers, args.tabular_model, args.timeseries_model)
+    print("\n--- Per-Window Scores ---")
+    print(window_scores.to_string(index=False, float_format='%.3f'))
+    print("\n--- Summary ---")
+    print(model_summary.to_string(index=False, float_format='%.3f'))
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    window_scores.to_csv(args.output, index=False)
+    print(f"\nPer-window scores saved to {args.output}")
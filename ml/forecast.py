@@ -0,0 +1,77 @@
+import argparse
+import datetime
+import hashlib
+import os
+import time
+import numpy as np
+import pandas as pd
+from autogluon.timeseries import TimeSeriesPredictor
+from ml.storage import FORECAST_PATH, DATASET_PATH, read_forecast_metadata, write_forecast_table
+from ml.train_timeseries import TIMESERIES_MODEL_PATH, load_aqi_series
+
+
+def _signature(data, model_path):
+    """Identifies the input series and model version a forecast table was computed from."""
+    digest = hashlib.sha1()
+    digest.update(pd.util.hash_pandas_object(pd.DataFrame(data).reset_index(), index=False).to_numpy().tobytes())
+    for name in ('predictor.pkl', 'learner.pkl'):
+        path = os.path.join(model_path, name)
+        if os.path.exists(path):
+            st = os.stat(path)
+            digest.update(f"{name}:{st.st_size}:{st.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
+
+
+def precompute_forecasts(predictor=None, data=None, model_path=TIMESERIES_MODEL_PATH,
+                         output_path=FORECAST_PATH, force=False):
+    """
+    Forecasts every series with one `TimeSeriesPredictor.predict` call and stores the mean
+    and quantile forecasts in the table served by `/api/forecast/<city>`.
+
+    Meant to run after each data refresh (e.g. from cron). The table records a signature of
+    the input series and the model files, so the job does nothing unless one of them changed
+    or `force` is set.
+
+    Returns:
+        str: The path of the written table, or None if it was already up to date.
+    """
+    if data is None:
+        data = load_aqi_series()
+    signature = _signature(data, model_path)
+    if not force and read_forecast_metadata(output_path).get('signature') == signature:
+        print(f"Forecast table {output_path} is up to date.")
+        return None
+
+    if predictor is None:
+        predictor = TimeSeriesPredictor.load(model_path)
+    start = time.perf_counter()
+    forecast = predictor.predict(data)
+    seconds = time.perf_counter() - start
+
+    # One row per (item, day): the mean and every quantile; float32 keeps the table compact
+    table = pd.DataFrame(forecast).reset_index().sort_values(['item_id', 'timestamp'], kind='stable')
+    value_columns = [c for c in table.columns if c not in ('item_id', 'timestamp')]
+    table[value_columns] = table[value_columns].astype(np.float32)
+    metadata = {
+        'signature': signature,
+        'generated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'model_path': model_path,
+        'prediction_length': int(predictor.prediction_length),
+        'quantiles': [c for c in value_columns if c != 'mean'],
+        'predict_seconds': round(seconds, 3),
+    }
+    write_forecast_table(table.reset_index(drop=True), metadata, output_path)
+    print(f"Forecast {table['item_id'].nunique()} series x {metadata['prediction_length']} days "
+          f"in {seconds:.2f}s; saved to {output_path}")
+    return output_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precompute the multi-day AQI forecast table.")
+    parser.add_argument('--force', action='store_true', help="recompute even if the data and model are unchanged")
+    args = parser.parse_args()
+    try:
+        precompute_forecasts(force=args.force)
+    except FileNotFoundError:
+        print(f"Error: Processed data not found at {DATASET_PATH}")
+        print("Please run `python -m ml.prepare_data` first.")
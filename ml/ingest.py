@@ -0,0 +1,255 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from ml.aqi import POLLUTANT_UNITS
+
+# Default memory budget for streaming the raw OpenAQ measurements
+DEFAULT_MEMORY_BUDGET_MB = 256
+# Rough upper bound of the in-memory size of one parsed row, used until it is measured
+_INITIAL_BYTES_PER_ROW = 512
+# Columns read from the raw OpenAQ measurements
+OPENAQ_COLUMNS = ('date.utc', 'value', 'parameter', 'unit')
+
+# Readings are converted to the unit of their pollutant's AQI breakpoint table. Mass
+# concentrations of gases are converted to mixing ratios at 25 °C and 1 atm
+# (24.45 L/mol): ppb = µg/m³ * 24.45 / molecular weight.
+_MOLAR_VOLUME = 24.45
+_MOLECULAR_WEIGHTS = {'o3': 48.00, 'co': 28.01, 'so2': 64.07, 'no2': 46.01}
+_MASS_UNITS = {'ug/m3': 1.0, 'mg/m3': 1000.0}      # in µg/m³
+_MIXING_RATIO_UNITS = {'ppb': 1.0, 'ppm': 1000.0}  # in ppb
+
+
+# Every finite double is an integer multiple of 2**-1126 once its 53-bit mantissa is
+# taken as an integer (the smallest subnormal is 2**-1074), so sums are kept as exact
+# Python integers in these units.
+_EXACT_SHIFT = 1126
+# Mantissas are split into two 27-bit halves whose per-group float64 sums stay exact
+# (below 2**53) for up to 2**26 values per call to np.bincount
+_HALF_BITS = 27
+_MAX_EXACT_ROWS = 1 << 26
+
+
+class DailyMeanAccumulator:
+    """
+    Running per-(date, parameter) sums and counts that produce the daily pivot of
+    `df.pivot_table(index='date', columns='parameter', values='value', aggfunc='mean')`.
+
+    Sums are exact (integer arithmetic on the values' mantissas), and each mean is the
+    exact sum divided by the count with a single rounding. The result therefore does not
+    depend on how the input is split into chunks or in which order rows arrive, so an
+    incremental run gives the same means as a full rebuild. It can differ from pandas'
+    compensated float sum by at most the last bit. Each chunk is reduced with vectorized
+    `np.bincount` calls, so the cost grows with the number of rows and (date, parameter)
+    pairs, not with the size of the largest group. Memory grows with the number of
+    (date, parameter) pairs, not with the number of measurements.
+    """
+
+    def __init__(self):
+        self._slots = {}  # (date, parameter) -> slot in the lists below
+        self._sums = []   # exact sum in units of 2**-_EXACT_SHIFT
+        self._count = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def add(self, dates, parameters, values):
+        """Adds one chunk of measurements (array-likes). NaN or infinite values and NaN keys are skipped."""
+        chunk = pd.DataFrame({'date': dates, 'parameter': parameters, 'value': values})
+        chunk = chunk.dropna()
+        chunk = chunk[np.isfinite(chunk['value'].to_numpy(dtype=float))]
+        for start in range(0, len(chunk), _MAX_EXACT_ROWS):
+            self._add(chunk.iloc[start:start + _MAX_EXACT_ROWS])
+
+    def _add(self, chunk):
+        # Factorizing the key columns separately avoids building a tuple per row
+        date_codes, date_uniques = pd.factorize(chunk['date'])
+        parameter_codes, parameter_uniques = pd.factorize(chunk['parameter'])
+        codes, pairs = pd.factorize(date_codes * len(parameter_uniques) + parameter_codes)
+        uniques = [(date_uniques[pair // len(parameter_uniques)], parameter_uniques[pair % len(parameter_uniques)])
+                   for pair in pairs.tolist()]
+        slots = [self._slot(key) for key in uniques]
+
+        # value = mantissa * 2**(exponent - 53) with an integer mantissa below 2**53
+        mantissa, exponent = np.frexp(chunk['value'].to_numpy(dtype=float))
+        mantissa = (mantissa * 2.0 ** 53).astype(np.int64)
+        high = mantissa >> _HALF_BITS
+        low = mantissa - (high << _HALF_BITS)
+        exponents, exponent_index = np.unique(exponent, return_inverse=True)
+
+        # One bin per (group, exponent); the float64 sums of the halves are exact integers
+        bins = codes * len(exponents) + exponent_index.reshape(-1)
+        size = len(uniques) * len(exponents)
+        high_sums = np.bincount(bins, weights=high, minlength=size)
+        low_sums = np.bincount(bins, weights=low, minlength=size)
+        for b in np.flatnonzero((high_sums != 0) | (low_sums != 0)):
+            group, e = divmod(int(b), len(exponents))
+            total = (int(high_sums[b]) << _HALF_BITS) + int(low_sums[b])
+            self._sums[slots[group]] += total << (int(exponents[e]) - 53 + _EXACT_SHIFT)
+        np.add.at(self._count, slots, np.bincount(codes, minlength=len(uniques)))
+
+    def _slot(self, key):
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = len(self._slots)
+            self._slots[key] = slot
+            self._sums.append(0)
+            if slot >= len(self._count):
+                grow = max(64, len(self._count))
+                self._count = np.concatenate([self._count, np.zeros(grow, dtype=np.int64)])
+        return slot
+
+    def to_pivot(self):
+        """Returns the daily pivot, in the same layout as `pivot_table(...).reset_index()`."""
+        if not self._slots:
+            return pd.DataFrame(columns=['date'])
+        keys = list(self._slots)
+        slots = np.fromiter(self._slots.values(), dtype=np.int64, count=len(keys))
+        # Integer true division is correctly rounded
+        scale = 1 << _EXACT_SHIFT
+        means = pd.Series(
+            [self._sums[slot] / (scale * int(self._count[slot])) for slot in slots],
+            index=pd.MultiIndex.from_tuples(keys, names=['date', 'parameter']),
+        )
+        return means.unstack('parameter').sort_index().sort_index(axis=1).reset_index()
+
+    def split_after(self, date):
+        """Returns a new accumulator holding only the groups after `date`."""
+        tail = DailyMeanAccumulator()
+        for key, slot in self._slots.items():
+            if key[0] > date:
+                new_slot = tail._slot(key)
+                tail._sums[new_slot] = self._sums[slot]
+                tail._count[new_slot] = self._count[slot]
+        return tail
+
+    def dates(self):
+        return {key[0] for key in self._slots}
+
+
+def _normalize_unit(unit):
+    return str(unit).strip().lower().replace('µ', 'u').replace('μ', 'u').replace('³', '3')
+
+
+def _unit_scale(parameter, unit):
+    """Size of one `unit` of `parameter` in µg/m³ (particles) or ppb (gases); None if unknown."""
+    weight = _MOLECULAR_WEIGHTS.get(parameter)
+    if unit in _MASS_UNITS:
+        return _MASS_UNITS[unit] * (_MOLAR_VOLUME / weight if weight else 1.0)
+    if unit in _MIXING_RATIO_UNITS and weight:
+        return _MIXING_RATIO_UNITS[unit]
+    return None
+
+
+def unit_factor(parameter, unit):
+    """
+    Factor converting readings of `parameter` in `unit` to the unit of its AQI breakpoint
+    table, or NaN if the unit cannot be converted. Parameters without a table are kept as is.
+    """
+    if parameter not in POLLUTANT_UNITS:
+        return 1.0
+    unit = _normalize_unit(unit)
+    if unit == _normalize_unit(POLLUTANT_UNITS[parameter]):
+        return 1.0
+    scale = _unit_scale(parameter, unit)
+    if scale is None:
+        return np.nan
+    return scale / _unit_scale(parameter, _normalize_unit(POLLUTANT_UNITS[parameter]))
+
+
+def to_table_units(parameters, values, units):
+    """
+    Converts OpenAQ readings to the units of the AQI breakpoint tables (PM in µg/m³,
+    CO in ppm, O3/SO2/NO2 in ppb). Readings in units that cannot be converted become NaN,
+    so the accumulator drops them.
+    """
+    parameter_codes, parameter_values = pd.factorize(parameters, use_na_sentinel=False)
+    unit_codes, unit_values = pd.factorize(units, use_na_sentinel=False)
+    factors = np.array([[unit_factor(parameter, unit) for unit in unit_values] for parameter in parameter_values],
+                       dtype=float).reshape(len(parameter_values), len(unit_values))
+    return np.asarray(values, dtype=float) * factors[parameter_codes, unit_codes]
+
+
+def _chunk_rows(memory_budget_mb, bytes_per_row):
+    # Leave room for the copies made while parsing and grouping a chunk
+    return max(1000, int(memory_budget_mb * 1024 * 1024 / 4 / bytes_per_row))
+
+
+def iter_openaq_chunks(source, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, columns=OPENAQ_COLUMNS):
+    """
+    Yields the raw OpenAQ measurements in chunks whose parsed size stays within the budget.
+    `source` is a CSV/Parquet path or a file-like object holding CSV data. Requested
+    columns the source does not have are left out of the chunks.
+    """
+    columns = list(columns)
+    if isinstance(source, str) and source.endswith('.parquet'):
+        parquet = pq.ParquetFile(source)
+        columns = [c for c in columns if c in parquet.schema_arrow.names]
+        # Measured like the CSV branch: the decoded size of a sample batch
+        bytes_per_row = _INITIAL_BYTES_PER_ROW
+        sample = next(parquet.iter_batches(batch_size=1000, columns=columns), None)
+        if sample is not None and sample.num_rows:
+            bytes_per_row = max(1, int(sample.to_pandas().memory_usage(deep=True).sum() / sample.num_rows))
+        for batch in parquet.iter_batches(batch_size=_chunk_rows(memory_budget_mb, bytes_per_row), columns=columns):
+            yield batch.to_pandas()
+        return
+
+    # Measure the parsed row size on a small sample, then stream with a fitting chunk size
+    bytes_per_row = _INITIAL_BYTES_PER_ROW
+    usecols = columns.__contains__
+    if isinstance(source, str):
+        sample = pd.read_csv(source, usecols=usecols, nrows=1000)
+        if len(sample):
+            bytes_per_row = max(1, int(sample.memory_usage(deep=True).sum() / len(sample)))
+    with pd.read_csv(source, usecols=usecols, chunksize=_chunk_rows(memory_budget_mb, bytes_per_row)) as reader:
+        yield from reader
+
+
+def stream_openaq_daily(source, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, accumulator=None):
+    """
+    Streams raw OpenAQ measurements into a `DailyMeanAccumulator` with bounded memory.
+    Readings are converted to the units of the AQI breakpoint tables first (sources
+    without a `unit` column are assumed to use them already); readings in other units
+    are dropped.
+
+    Returns:
+        tuple: The accumulator and ingestion statistics (rows, dropped rows, seconds,
+        rows/second, chunks).
+    """
+    accumulator = accumulator if accumulator is not None else DailyMeanAccumulator()
+    rows = 0
+    dropped = 0
+    chunks = 0
+    start = time.perf_counter()
+    for chunk in iter_openaq_chunks(source, memory_budget_mb):
+        dates = pd.to_datetime(chunk['date.utc']).dt.date
+        values = chunk['value']
+        if 'unit' in chunk.columns:
+            values = to_table_units(chunk['parameter'], values, chunk['unit'])
+            dropped += int((np.isnan(values) & chunk['value'].notna().to_numpy()).sum())
+        accumulator.add(dates, chunk['parameter'], values)
+        rows += len(chunk)
+        chunks += 1
+    seconds = time.perf_counter() - start
+    stats = {
+        'rows': rows,
+        'dropped_rows': dropped,
+        'chunks': chunks,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds > 0 else float('inf'),
+        'groups': len(accumulator),
+    }
+    name = source if isinstance(source, str) else 'appended rows'
+    print(f"Ingested {rows} OpenAQ rows from {name} in {chunks} chunk(s), "
+          f"{seconds:.2f}s ({stats['rows_per_second']:,.0f} rows/s), {len(accumulator)} daily groups")
+    if dropped:
+        print(f"Warning: dropped {dropped} OpenAQ rows in units that do not convert to the AQI breakpoint tables")
+    return accumulator, stats
+
+
+def raw_path(name, data_dir='data'):
+    """Returns the Parquet copy of a raw input if it exists, else its CSV path."""
+    parquet_path = os.path.join(data_dir, f'{name}.parquet')
+    return parquet_path if os.path.exists(parquet_path) else os.path.join(data_dir, f'{name}.csv')
@@ -0,0 +1,360 @@
+import argparse
+import cProfile
+import datetime
+import hashlib
+import io
+import json
+import os
+import pickle
+import pstats
+import resource
+import time
+
+import pandas as pd
+
+from ml.ingest import DEFAULT_MEMORY_BUDGET_MB, raw_path
+from ml.storage import ARROW_PATH, CSV_PATH, DATA_DIR, DATASET_PATH, FORECAST_PATH
+
+# --- Local layout ---
+# The last output of every stage, keyed by the hash of its inputs
+CACHE_DIR = os.path.join(DATA_DIR, 'pipeline_cache')
+# One JSON line per run with the wall time, peak RSS and rows of every stage
+REPORT_PATH = os.path.join(DATA_DIR, 'pipeline_runs.jsonl')
+# cProfile output of each stage when run with --profile
+PROFILE_DIR = os.path.join(DATA_DIR, 'pipeline_profiles')
+
+_HASH_BLOCK_SIZE = 1 << 20
+
+
+class Stage:
+    """
+    One step of the pipeline: `fn(*outputs of deps, **params)`.
+
+    The stage is skipped and its cached output reused when its cache key is unchanged.
+    The key covers the stage's params, the content hashes of its dependencies' outputs,
+    of the files returned by `inputs()` and of its `code` files. `outputs` are files the
+    stage writes as a side effect; the cache is only used while they all exist.
+    """
+
+    def __init__(self, name, fn, deps=(), params=None, inputs=None, outputs=(), code=()):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.params = params or {}
+        self.inputs = inputs
+        self.outputs = list(outputs)
+        self.code = list(code)
+
+
+def file_hash(paths):
+    """Content hash of files (directories are walked in sorted order; missing paths count as such)."""
+    digest = hashlib.sha1()
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        for file_path in files:
+            digest.update(file_path.encode())
+            if not os.path.isfile(file_path):
+                digest.update(b'<missing>')
+                continue
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b''):
+                    digest.update(block)
+    return digest.hexdigest()
+
+
+def content_hash(value):
+    """Hash of a stage output. DataFrames are hashed by their columns, dtypes and values."""
+    digest = hashlib.sha1()
+    _update_hash(digest, value)
+    return digest.hexdigest()
+
+
+def _update_hash(digest, value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        frame = value.to_frame() if isinstance(value, pd.Series) else value
+        digest.update(repr([(str(c), str(t)) for c, t in frame.dtypes.items()]).encode())
+        digest.update(pd.util.hash_pandas_object(frame, index=True).to_numpy().tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value, key=str):
+            digest.update(str(key).encode())
+            _update_hash(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _update_hash(digest, item)
+    else:
+        digest.update(pickle.dumps(value))
+
+
+def _reset_peak_rss():
+    """Resets the kernel's peak RSS counter of this process (Linux only). Returns whether it worked."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    """Peak RSS of this process since the last reset (or since it started) in MB."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if peak > 1 << 32 else peak / 1024
+
+
+def _children_peak_rss_mb():
+    """Largest peak RSS of any finished child process (e.g. model fitting workers) in MB."""
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+def _rows(value):
+    return len(value) if isinstance(value, (pd.DataFrame, pd.Series)) else None
+
+
+class Pipeline:
+    """
+    Runs stages as a DAG in dependency order, passing each stage's output to its
+    dependents in memory and skipping stages whose inputs have not changed.
+    """
+
+    def __init__(self, stages, cache_dir=CACHE_DIR):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_dir = cache_dir
+        for stage in stages:
+            unknown = [dep for dep in stage.deps if dep not in self.stages]
+            if unknown:
+                raise ValueError(f"Stage {stage.name} depends on unknown stages {unknown}")
+
+    def order(self, targets=None):
+        """The stages needed for `targets` (default: all), dependencies first."""
+        ordered, visiting = [], set()
+
+        def visit(name):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError(f"Dependency cycle through stage {name}")
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage {name}; stages are {sorted(self.stages)}")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            visiting.discard(name)
+            ordered.append(name)
+
+        for name in targets or self.stages:
+            visit(name)
+        return ordered
+
+    def _cache_path(self, name):
+        return os.path.join(self.cache_dir, f'{name}.pkl')
+
+    def _cache_key(self, stage, dep_hashes):
+        digest = hashlib.sha1(stage.name.encode())
+        digest.update(json.dumps(stage.params, sort_keys=True, default=str).encode())
+        for dep in stage.deps:
+            digest.update(dep_hashes[dep].encode())
+        if stage.inputs is not None:
+            digest.update(file_hash(stage.inputs()).encode())
+        digest.update(file_hash(stage.code).encode())
+        return digest.hexdigest()
+
+    def _load_cached(self, stage, key):
+        path = self._cache_path(stage.name)
+        if not os.path.exists(path) or not all(os.path.exists(p) for p in stage.outputs):
+            return None
+        with open(path, 'rb') as f:
+            entry = pickle.load(f)
+        return entry if entry['key'] == key else None
+
+    def _save_cached(self, stage, key, output, output_hash):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self._cache_path(stage.name) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'key': key, 'output': output, 'output_hash': output_hash}, f)
+        os.replace(tmp_path, self._cache_path(stage.name))
+
+    def run(self, targets=None, force=False, profile_dir=None):
+        """
+        Runs the stages needed for `targets`.
+
+        Args:
+            targets (list, optional): Stage names to run (with their dependencies).
+            force (bool): Run every stage even if its cached output is up to date.
+            profile_dir (str, optional): Run each executed stage under cProfile and save
+                the stats to `<profile_dir>/<stage>.prof`.
+
+        Returns:
+            tuple: The outputs by stage name and one measurement record per stage.
+        """
+        outputs, hashes, records = {}, {}, []
+        for name in self.order(targets):
+            stage = self.stages[name]
+            args = [outputs[dep] for dep in stage.deps]
+            rows_in = [_rows(arg) for arg in args]
+            key = self._cache_key(stage, hashes)
+            record = {
+                'stage': name,
+                'key': key[:16],
+                'rows_in': sum(r for r in rows_in if r is not None) if any(r is not None for r in rows_in) else None,
+            }
+
+            start = time.perf_counter()
+            entry = None if force else self._load_cached(stage, key)
+            if entry is not None:
+                output, output_hash = entry['output'], entry['output_hash']
+                record.update(cached=True, wall_seconds=round(time.perf_counter() - start, 3))
+                print(f"[pipeline] {name}: inputs unchanged, using the cached output")
+            else:
+                print(f"[pipeline] {name}: running")
+                peak_is_per_stage = _reset_peak_rss()
+                start = time.perf_counter()
+                if profile_dir is not None:
+                    profiler = cProfile.Profile()
+                    output = profiler.runcall(stage.fn, *args, **stage.params)
+                else:
+                    output = stage.fn(*args, **stage.params)
+                wall = time.perf_counter() - start
+                if output is None:
+                    raise RuntimeError(f"Stage {name} produced no output")
+                output_hash = content_hash(output)
+                self._save_cached(stage, key, output, output_hash)
+                record.update(
+                    cached=False,
+                    wall_seconds=round(wall, 3),
+                    # Without a resettable counter this is the process peak so far
+                    peak_rss_mb=round(_peak_rss_mb(), 1),
+                    peak_rss_scope='stage' if peak_is_per_stage else 'process',
+                    children_peak_rss_mb=round(_children_peak_rss_mb(), 1),
+                )
+                if profile_dir is not None:
+                    os.makedirs(profile_dir, exist_ok=True)
+                    record['profile'] = os.path.join(profile_dir, f'{name}.prof')
+                    profiler.dump_stats(record['profile'])
+            record['rows_out'] = _rows(output)
+            outputs[name], hashes[name] = output, output_hash
+            records.append(record)
+        return outputs, records
+
+
+# --- Retraining stages ---
+
+def _prepare(memory_budget_mb):
+    from ml.prepare_data import prepare_data
+    return prepare_data(memory_budget_mb=memory_budget_mb)
+
+
+def _train_tabular(final_df, **params):
+    from ml.train import train_tabular_model
+    return train_tabular_model(final_df, **params)
+
+
+def _train_timeseries(final_df, **params):
+    from ml.train_timeseries import train_timeseries_model
+    return train_timeseries_model(final_df, **params)
+
+
+def _raw_inputs():
+    from ml.prepare_data import NOAA_NAME, OPENAQ_NAME
+    return [raw_path(OPENAQ_NAME), raw_path(NOAA_NAME)]
+
+
+def build_retraining_pipeline(memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, time_limit=180,
+                              presets='best_quality', export=True, cache_dir=CACHE_DIR):
+    """
+    The retraining job as a DAG: `prepare` (raw inputs -> engineered data) feeds
+    `train_tabular` and `train_timeseries` (which also writes the forecast table).
+    The training stages receive the engineered data in memory.
+    """
+    from ml.prepare_data import STATE_PATH
+    from ml.train import DEPLOY_MODEL_PATH, TABULAR_MODEL_PATH
+    from ml.train_timeseries import TIMESERIES_MODEL_PATH
+
+    def code(*modules):
+        return [os.path.join(os.path.dirname(__file__), f'{module}.py') for module in modules]
+
+    return Pipeline([
+        Stage('prepare', _prepare,
+              params={'memory_budget_mb': memory_budget_mb},
+              inputs=_raw_inputs,
+              outputs=[CSV_PATH, DATASET_PATH, ARROW_PATH, STATE_PATH],
+              code=code('prepare_data', 'ingest', 'storage', 'aqi')),
+        Stage('train_tabular', _train_tabular, deps=['prepare'],
+              params={'time_limit': time_limit, 'presets': presets, 'export': export},
+              # With `export`, the stage also writes the deployment model served by the backend
+              outputs=[TABULAR_MODEL_PATH] + ([DEPLOY_MODEL_PATH] if export else []),
+              code=code('train', 'aqi')),
+        Stage('train_timeseries', _train_timeseries, deps=['prepare'],
+              params={'time_limit': time_limit, 'presets': presets},
+              outputs=[TIMESERIES_MODEL_PATH, FORECAST_PATH],
+              code=code('train_timeseries', 'train', 'forecast', 'aqi')),
+    ], cache_dir=cache_dir)
+
+
+def append_report(records, report_path=REPORT_PATH, **meta):
+    """Appends one run's stage records to the JSON-lines report."""
+    run = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'cpu_count': os.cpu_count(),
+        **meta,
+        'stages': records,
+    }
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+    with open(report_path, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    return run
+
+
+def format_records(records):
+    lines = [f"{'stage':<18}{'cached':>8}{'wall s':>10}{'peak MB':>10}{'rows in':>10}{'rows out':>10}"]
+    for r in records:
+        peak = r.get('peak_rss_mb')
+        lines.append(f"{r['stage']:<18}{'yes' if r['cached'] else 'no':>8}{r['wall_seconds']:>10.2f}"
+                     f"{'-' if peak is None else f'{peak:.0f}':>10}"
+                     f"{'-' if r['rows_in'] is None else r['rows_in']:>10}"
+                     f"{'-' if r['rows_out'] is None else r['rows_out']:>10}")
+    return '\n'.join(lines)
+
+
+def _print_profile(path, limit=15):
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(limit)
+    print(out.getvalue())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the retraining pipeline (prepare -> train / train_timeseries).")
+    parser.add_argument('--stages', nargs='+', help="only run these stages (and what they depend on)")
+    parser.add_argument('--force', action='store_true', help="rerun stages even if their inputs are unchanged")
+    parser.add_argument('--profile', action='store_true',
+                        help=f"run each stage under cProfile and save the stats to {PROFILE_DIR}")
+    parser.add_argument('--time-limit', type=int, default=180, help="AutoGluon fit time limit per model (seconds)")
+    parser.add_argument('--presets', default='best_quality')
+    parser.add_argument('--no-export', action='store_true', help="skip the tabular deployment model export")
+    parser.add_argument('--memory-budget-mb', type=float, default=DEFAULT_MEMORY_BUDGET_MB,
+                        help="memory budget for streaming the raw OpenAQ measurements")
+    parser.add_argument('--report', default=REPORT_PATH)
+    args = parser.parse_args()
+
+    pipeline = build_retraining_pipeline(args.memory_budget_mb, args.time_limit, args.presets, not args.no_export)
+    start = time.perf_counter()
+    _, stage_records = pipeline.run(args.stages, force=args.force,
+                                     profile_dir=PROFILE_DIR if args.profile else None)
+    append_report(stage_records, args.report, total_seconds=round(time.perf_counter() - start, 3),
+                  time_limit=args.time_limit, presets=args.presets)
+    print()
+    print(format_records(stage_records))
+    for stage_record in stage_records:
+        if 'profile' in stage_record:
+            print(f"\n--- Profile of {stage_record['stage']} ({stage_record['profile']}) ---")
+            _print_profile(stage_record['profile'])
+    print(f"Run report appended to {args.report}")
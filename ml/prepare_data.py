@@ -1,137 +1,353 @@
 import pandas as pd
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import argparse
+import io
 import os
-import boto3
-from botocore import UNSIGNED
-from botocore.client import Config
+import pickle
+import time
+from ml.aqi import POLLUTANTS
+from ml.storage import read_raw, write_final_data, append_final_data, CSV_PATH, DATASET_PATH, ARROW_PATH
+from ml.ingest import DEFAULT_MEMORY_BUDGET_MB, raw_path, stream_openaq_daily
+from ml.s3_download import download_partitions
 
-def download_data_from_s3():
+def download_data_from_s3(**kwargs):
     """
-    Downloads the required datasets from public AWS S3 buckets if they don't already exist.
+    Downloads the required datasets from public AWS S3 buckets, skipping parts that are
+    already present. By default:
     - NOAA GSOD (Global Surface Summary of the Day) for Chicago O'Hare.
-    - OpenAQ data for Chicago (PM2.5 and O3).
+    - OpenAQ data for Chicago (PM2.5 and O3), January and February 2024.
+
+    Keyword arguments (stations, cities, months, parameters, max_workers, ...) are passed
+    to `ml.s3_download.download_partitions`.
     """
     print("Checking for required data files...")
-    os.makedirs('data', exist_ok=True)
-    
-    # Initialize S3 client for public access
-    s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
-    
-    # --- File 1: NOAA GSOD Weather Data ---
-    noaa_bucket = 'noaa-gsod-pds'
-    noaa_key = '2024/725300-94846.csv' # Chicago O'Hare International Airport for 2024
-    noaa_local_path = os.path.join('data', 'noaa-chicago-2024.csv')
-    
-    if not os.path.exists(noaa_local_path):
-        print(f"Downloading NOAA data from s3://{noaa_bucket}/{noaa_key}...")
-        try:
-            s3.download_file(noaa_bucket, noaa_key, noaa_local_path)
-            print("NOAA data download complete.")
-        except Exception as e:
-            print(f"Error downloading NOAA data: {e}")
-            raise
-    else:
-        print("NOAA data already exists.")
+    return download_partitions(**kwargs)
 
-    # --- File 2: OpenAQ Air Quality Data (using v2 parquet for efficiency) ---
-    openaq_bucket = 'openaq-v2-post-etl-bucket'
-    # Download PM2.5 and O3 data for Chicago for a few months in 2023
-    openaq_local_path = os.path.join('data', 'openaq-chicago-2024.parquet')
-    
-    if not os.path.exists(openaq_local_path):
-        print("Downloading OpenAQ data for Chicago (this may take a moment)...")
-        try:
-            # For this prototype, we'll fetch PM2.5 data for a few months and save it.
-            # In a real scenario, you'd query a wider range of data.
-            keys_to_download = [
-                'data/v2/measures/parquet/city=Chicago/month=2024-01/parameter=pm25/',
-                'data/v2/measures/parquet/city=Chicago/month=2024-02/parameter=pm25/',
-                'data/v2/measures/parquet/city=Chicago/month=2024-01/parameter=o3/',
-                'data/v2/measures/parquet/city=Chicago/month=2024-02/parameter=o3/'
-            ]
-            
-            all_files = []
-            paginator = s3.get_paginator('list_objects_v2')
-            for prefix in keys_to_download:
-                pages = paginator.paginate(Bucket=openaq_bucket, Prefix=prefix)
-                for page in pages:
-                    if 'Contents' in page:
-                        for obj in page['Contents']:
-                            all_files.append(obj['Key'])
-            
-            if not all_files:
-                raise Exception("No OpenAQ files found for the specified paths.")
-
-            df_list = []
-            for i, key in enumerate(all_files):
-                print(f"  Downloading part {i+1}/{len(all_files)}: {key}")
-                obj = s3.get_object(Bucket=openaq_bucket, Key=key)
-                df_list.append(pd.read_parquet(obj['Body']))
-
-            full_df = pd.concat(df_list, ignore_index=True)
-            full_df.to_parquet(openaq_local_path)
-            print("OpenAQ data download and consolidation complete.")
-        except Exception as e:
-            print(f"Error downloading OpenAQ data: {e}")
-            raise
+# --- Feature engineering settings ---
+BASE_COLUMNS = ['date', 'pm25', 'o3', 'TEMP', 'WDSP', 'PRCP']
+ROLLING_FEATURES = ['pm25', 'o3', 'TEMP', 'WDSP']
+ROLLING_WINDOW = 7
+# Column identifying each series in long-format (multi-city) data
+CITY_KEY = 'city'
+
+# Raw inputs and the columns read from them (see `ml.ingest.OPENAQ_COLUMNS` for OpenAQ)
+OPENAQ_NAME = 'openaq_chicago_sample'
+NOAA_NAME = 'noaa_gsod_chicago_sample'
+NOAA_COLUMNS = ['DATE', 'TEMP', 'WDSP', 'PRCP']
+
+# State kept between runs for incremental preparation: the watermark (last processed
+# date), the trailing rows needed by the rolling features, the data that arrived after
+# the watermark but could not be merged yet (OpenAQ as daily accumulators, NOAA as rows),
+# and how far each raw CSV was read.
+STATE_PATH = os.path.join('data', 'prepare_state.pkl')
+# Bumped when the saved state's layout changes; older states trigger a full rebuild
+STATE_VERSION = 3
+# A raw CSV whose last line has no newline is treated as complete once the file has not
+# been modified for this long, as a full rebuild (which reads it to EOF) would
+APPEND_SETTLE_SECONDS = 0.5
+
+
+def _parse_noaa(noaa_df):
+    noaa_df['date'] = pd.to_datetime(noaa_df['DATE']).dt.date
+    return noaa_df
+
+
+def _merge_daily(aq_pivot, noaa_df, columns=None):
+    """Joins the daily OpenAQ pivot with the NOAA weather data."""
+    merged = pd.merge(aq_pivot, noaa_df, on='date', how='inner')
+    merged = merged.drop(columns=['DATE'])
+    if columns is None:
+        # Any additional EPA pollutants present in the OpenAQ feed (PM10, CO, SO2, NO2)
+        # are kept for the AQI target.
+        columns = BASE_COLUMNS + [p for p in POLLUTANTS if p not in BASE_COLUMNS and p in merged.columns]
+    return merged.reindex(columns=columns)
+
+
+def _rolling_mean_shifted(values, window=ROLLING_WINDOW, positions=None):
+    """
+    Mean of the previous `window` values (NaNs ignored), i.e. `rolling(window, min_periods=1)
+    .mean().shift(1)`. Each mean is computed from its own window only, so the result for a row
+    does not depend on how much earlier history was processed in the same call.
+
+    `positions` gives each row's position within its group (rows of a group must be
+    contiguous); windows are then cut at the group boundaries, so several series are
+    handled in one pass with the same result as one call per series.
+    """
+    values = np.asarray(values, dtype=float)
+    padded = np.concatenate([np.full(window, np.nan), values])
+    windows = sliding_window_view(padded, window)[:len(values)]
+    if positions is not None:
+        # Window slot j holds the row `window - j` rows back; it belongs to the group
+        # only if the row is at least that far into the group
+        outside = np.arange(window) < (window - np.asarray(positions))[:, None]
+        windows = np.where(outside, np.nan, windows)
+    counts = (~np.isnan(windows)).sum(axis=1)
+    sums = np.nansum(windows, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def engineer_features(daily_df, history=None, key=CITY_KEY):
+    """
+    Fills missing values and adds the rolling and calendar features.
+
+    `daily_df` is a long-format frame with one merged row per (`key`, date), e.g. one
+    series per city or station; without a `key` column it is treated as a single series.
+    Every step runs once over the whole frame: the forward/backward fills are grouped by
+    `key` and the rolling windows are cut at group boundaries, so the result is the same
+    as engineering each series on its own.
+
+    Args:
+        daily_df (DataFrame): Merged daily rows, sorted by date within each series.
+        history (DataFrame, optional): The trailing filled rows of the previous run; when
+            given, only `daily_df`'s rows are returned.
+        key (str): Column identifying the series.
+
+    Returns:
+        tuple: The engineered rows (ordered by `key`, then date) and the trailing filled
+        rows of each series to carry into the next run.
+    """
+    grouped = key in daily_df.columns
+    parts = [daily_df.assign(_new=True)]
+    if history is not None:
+        parts.insert(0, history.assign(_new=False))
+    filled = pd.concat(parts, ignore_index=True)
+
+    if grouped:
+        filled = filled.sort_values([key, 'date'], kind='stable', ignore_index=True)
+        value_columns = [c for c in filled.columns if c not in (key, 'date', '_new')]
+        filled[value_columns] = filled.groupby(key, sort=False)[value_columns].ffill()
+        filled[value_columns] = filled.groupby(key, sort=False)[value_columns].bfill()
+        positions = filled.groupby(key, sort=False).cumcount().to_numpy()
     else:
-        print("OpenAQ data already exists.")
+        filled = filled.ffill().bfill()
+        positions = None
+    is_new = filled.pop('_new').to_numpy(dtype=bool)
+
+    final_df = filled.set_index('date')
+    final_df.index = pd.to_datetime(final_df.index)
+
+    # Create rolling average features
+    for feature in ROLLING_FEATURES:
+        # Calculate 7-day rolling mean, shift by 1 to prevent data leakage (use past data to predict future)
+        final_df[f'{feature}_7d_mean'] = _rolling_mean_shifted(final_df[feature], positions=positions)
+
+    # Create time-based features
+    final_df['month'] = final_df.index.month
+    final_df['day_of_year'] = final_df.index.dayofyear
+    final_df['weekday'] = final_df.index.weekday
+
+    final_df = final_df[is_new].reset_index()
+    final_df.dropna(inplace=True) # Drop rows with NaNs created by rolling features
+    window = filled.groupby(key, sort=False).tail(ROLLING_WINDOW) if grouped else filled.tail(ROLLING_WINDOW)
+    return final_df, window.reset_index(drop=True)
+
+
+def _raw_csv_path(name):
+    path = os.path.join('data', f'{name}.csv')
+    # Incremental reads rely on byte offsets, so they are only possible for CSV inputs
+    if os.path.exists(os.path.join('data', f'{name}.parquet')):
+        return None
+    return path
+
+
+def _file_settled(path, size):
+    """Whether the file still has `size` bytes and has not been modified for `APPEND_SETTLE_SECONDS`."""
+    age = time.time() - os.path.getmtime(path)
+    if age < APPEND_SETTLE_SECONDS:
+        time.sleep(APPEND_SETTLE_SECONDS - age)
+    return os.path.getsize(path) == size and time.time() - os.path.getmtime(path) >= APPEND_SETTLE_SECONDS
+
 
-def prepare_data():
+def _read_appended_csv(path, offset):
+    """
+    Returns the complete rows appended to a CSV after `offset` as an in-memory CSV
+    (with the header line prepended), and the new offset.
+
+    A last line without a newline is complete once the file has stopped growing, since
+    a full rebuild reads it too; while the file is still being written it is left for
+    the next run.
+    """
+    with open(path, 'rb') as f:
+        header = f.readline()
+        f.seek(offset)
+        chunk = f.read()
+    end = chunk.rfind(b'\n') + 1
+    if end < len(chunk) and _file_settled(path, offset + len(chunk)):
+        end = len(chunk)
+    if header and not header.endswith(b'\n'):
+        header += b'\n'
+    rows = chunk[:end]
+    if rows and not rows.endswith(b'\n'):
+        rows += b'\n'
+    return io.BytesIO(header + rows), offset + end
+
+
+def _raw_csv_sizes():
+    sizes = {}
+    for name in (OPENAQ_NAME, NOAA_NAME):
+        path = _raw_csv_path(name)
+        if path is not None:
+            sizes[name] = os.path.getsize(path)
+    return sizes
+
+
+def _save_state(watermark, window, pending_openaq, pending_noaa, columns, offsets):
+    state = {
+        'version': STATE_VERSION,
+        'watermark': watermark,
+        'window': window,
+        'pending_openaq': pending_openaq,
+        'pending_noaa': pending_noaa,
+        'columns': columns,
+        'offsets': offsets,
+    }
+    with open(STATE_PATH, 'wb') as f:
+        pickle.dump(state, f)
+
+
+def _load_state():
+    if not os.path.exists(STATE_PATH) or not os.path.exists(CSV_PATH):
+        return None
+    with open(STATE_PATH, 'rb') as f:
+        state = pickle.load(f)
+    return state if state.get('version') == STATE_VERSION else None
+
+
+def prepare_data(incremental=False, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
     """
     Reads the downloaded data, cleans it, merges it, performs feature engineering,
     and saves the final dataset.
+
+    With `incremental=True`, only raw rows appended since the previous run are processed
+    and the new engineered rows are appended to the outputs, giving the same result as a
+    full rebuild. It falls back to a full rebuild when there is no saved state or when the
+    new data cannot be appended (late rows at or before the watermark, truncated raw
+    files, new pollutant columns, or gaps that a backward fill would change).
+
+    The raw OpenAQ measurements are streamed in chunks sized to `memory_budget_mb`.
+
+    Returns:
+        DataFrame: The engineered rows written by this run (only the appended rows of an
+        incremental run), so callers such as `ml.pipeline` can use them without re-reading
+        the outputs.
     """
+    if incremental:
+        appended_df, fallback_reason = _prepare_incremental(memory_budget_mb)
+        if fallback_reason is None:
+            return appended_df
+        print(f"Incremental preparation not possible ({fallback_reason}); running a full rebuild.")
+
     # Step 1: Ensure data is downloaded
     # download_data_from_s3()
 
     print("\nStarting data preparation and feature engineering...")
     
-    # Step 2: Load and process OpenAQ data
-    openaq_df = pd.read_csv(os.path.join('data', 'openaq_chicago_sample.csv'))
-    openaq_df['date'] = pd.to_datetime(openaq_df['date.utc']).dt.date
-    aq_pivot = openaq_df.pivot_table(index='date', columns='parameter', values='value', aggfunc='mean').reset_index()
+    raw_offsets = _raw_csv_sizes()
+
+    # Step 2: Stream the OpenAQ measurements into daily per-parameter means
+    # (Parquet copies of the raw files are preferred when present)
+    openaq_daily, _ = stream_openaq_daily(raw_path(OPENAQ_NAME), memory_budget_mb)
     
     # Step 3: Load and process NOAA data
-    noaa_df = pd.read_csv(os.path.join('data', 'noaa_gsod_chicago_sample.csv'))
-    noaa_df['date'] = pd.to_datetime(noaa_df['DATE']).dt.date
+    # Only the columns we use are read
+    noaa_df = _parse_noaa(read_raw(NOAA_NAME, columns=NOAA_COLUMNS))
     
-    # Step 4: Merge data
-    final_df = pd.merge(aq_pivot, noaa_df, on='date', how='inner')
-    final_df = final_df.drop(columns=['DATE', 'STATION', 'LATITUDE', 'LONGITUDE', 'ELEVATION', 'NAME'])
-
-    # Step 5: Clean and handle missing values
-    # We select key columns and fill missing values
-    features_to_keep = ['date', 'pm25', 'o3', 'TEMP', 'WDSP', 'PRCP']
-    final_df = final_df[features_to_keep]
-    final_df.ffill(inplace=True)
-    final_df.bfill(inplace=True)
-
-    # Step 6: Advanced Feature Engineering
+    # Step 4: Merge data and select the key columns
+    daily_df = _merge_daily(openaq_daily.to_pivot(), noaa_df)
+
+    # Step 5 & 6: Handle missing values and perform feature engineering
     print("Performing feature engineering...")
-    final_df.set_index('date', inplace=True)
-    final_df.index = pd.to_datetime(final_df.index)
-    
-    # Create rolling average features
-    rolling_features = ['pm25', 'o3', 'TEMP', 'WDSP']
-    for feature in rolling_features:
-        # Calculate 7-day rolling mean, shift by 1 to prevent data leakage (use past data to predict future)
-        final_df[f'{feature}_7d_mean'] = final_df[feature].rolling(window=7, min_periods=1).mean().shift(1)
-    
-    # Create time-based features
-    final_df['month'] = final_df.index.month
-    final_df['day_of_year'] = final_df.index.dayofyear
-    final_df['weekday'] = final_df.index.weekday
-    
-    final_df.reset_index(inplace=True)
-    final_df.dropna(inplace=True) # Drop rows with NaNs created by rolling features
+    final_df, window = engineer_features(daily_df)
 
     # Step 7: Save final data
-    output_path = os.path.join('data', 'final_data.csv')
-    final_df.to_csv(output_path, index=False)
-    
-    print(f"Data preparation complete. Final data with engineered features saved to {output_path}")
+    # Written next to the target and renamed: a reader of the old file (e.g. the backend's
+    # feature store) sees a new inode and reloads, instead of reading a rewrite as an append
+    tmp_path = f'{CSV_PATH}.tmp'
+    final_df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, CSV_PATH)
+    write_final_data(final_df)
+
+    # Save the state for incremental runs
+    watermark = daily_df['date'].max()
+    _save_state(
+        watermark, window,
+        openaq_daily.split_after(watermark),
+        noaa_df[noaa_df['date'] > watermark],
+        list(daily_df.columns),
+        raw_offsets,
+    )
+
+    print(f"Data preparation complete. Final data with engineered features saved to {CSV_PATH}, "
+          f"{DATASET_PATH} (Parquet, partitioned by city/month) and {ARROW_PATH}")
     print("\nFinal Data Head:")
     print(final_df.head())
+    return final_df
+
+
+def _prepare_incremental(memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    Appends newly arrived days to the outputs. Returns the appended rows and None, or
+    None and a reason string if a full rebuild is needed.
+    """
+    state = _load_state()
+    if state is None:
+        return None, "no saved state"
+
+    appended = {}
+    offsets = {}
+    for name in (OPENAQ_NAME, NOAA_NAME):
+        path = _raw_csv_path(name)
+        offset = state['offsets'].get(name)
+        if path is None or offset is None:
+            return None, f"{name} is not a CSV file"
+        if os.path.getsize(path) < offset:
+            return None, f"{name} was truncated or replaced"
+        appended[name], offsets[name] = _read_appended_csv(path, offset)
+
+    watermark = state['watermark']
+    # New measurements are added to the accumulators of the days still pending
+    openaq_daily, _ = stream_openaq_daily(appended[OPENAQ_NAME], memory_budget_mb, accumulator=state['pending_openaq'])
+    noaa_df = _parse_noaa(pd.read_csv(appended[NOAA_NAME], usecols=NOAA_COLUMNS))
+    if any(date <= watermark for date in openaq_daily.dates()) or (noaa_df['date'] <= watermark).any():
+        return None, f"rows at or before the watermark {watermark} arrived"
+    if state['window'].isna().any().any():
+        return None, "missing values would be backward filled"
+
+    noaa_df = pd.concat([state['pending_noaa'], noaa_df], ignore_index=True)
+    aq_pivot = openaq_daily.to_pivot()
+    new_parameters = set(aq_pivot.columns) & set(POLLUTANTS)
+    if not new_parameters <= set(state['columns']):
+        return None, f"new pollutant columns {sorted(new_parameters - set(state['columns']))}"
+
+    daily_df = _merge_daily(aq_pivot, noaa_df, columns=state['columns'])
+    window = state['window']
+    final_df = daily_df.iloc[:0]
+    if not daily_df.empty:
+        watermark = daily_df['date'].max()
+        final_df, window = engineer_features(daily_df, history=window)
+        final_df.to_csv(CSV_PATH, mode='a', header=False, index=False)
+        append_final_data(final_df)
+        print(f"Appended {len(final_df)} new rows up to {watermark} to {CSV_PATH}, {DATASET_PATH} and {ARROW_PATH}")
+    else:
+        print("No new complete days to append.")
+
+    _save_state(
+        watermark, window,
+        openaq_daily.split_after(watermark),
+        noaa_df[noaa_df['date'] > watermark],
+        state['columns'],
+        offsets,
+    )
+    return final_df, None
+
 
 if __name__ == '__main__':
-    prepare_data() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Prepare the engineered AQI dataset.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only process raw rows appended since the previous run")
+    parser.add_argument('--memory-budget-mb', type=float, default=DEFAULT_MEMORY_BUDGET_MB,
+                        help="memory budget for streaming the raw OpenAQ measurements")
+    args = parser.parse_args()
+    prepare_data(incremental=args.incremental, memory_budget_mb=args.memory_budget_mb)
@@ -0,0 +1,268 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+from ml.storage import DATA_DIR, RAW_TYPES
+
+# --- Sources ---
+NOAA_BUCKET = 'noaa-gsod-pds'                 # one CSV per station and year: <year>/<station>.csv
+OPENAQ_BUCKET = 'openaq-v2-post-etl-bucket'   # Parquet parts under city=/month=/parameter= prefixes
+OPENAQ_PREFIX = 'data/v2/measures/parquet'
+
+# Defaults match the original prototype download: Chicago O'Hare, PM2.5 and O3, Jan-Feb 2024
+DEFAULT_STATIONS = ['725300-94846']
+DEFAULT_CITIES = ['Chicago']
+DEFAULT_MONTHS = ('2024-01', '2024-02')
+DEFAULT_PARAMETERS = ['pm25', 'o3']
+DEFAULT_WORKERS = 8
+
+# --- Local layout ---
+# Every part is written to its own file in a hive-style partition directory as soon as it
+# arrives, so nothing is concatenated in memory:
+#   data/raw/noaa_gsod/year=2024/station=725300-94846/part-0.parquet
+#   data/raw/openaq/city=Chicago/month=2024-01/parameter=pm25/<part>.parquet
+RAW_DIR = os.path.join(DATA_DIR, 'raw')
+MANIFEST_NAME = '_manifest.jsonl'
+NOAA_TYPES = RAW_TYPES['noaa_gsod_chicago_sample']
+_READ_CHUNK_BYTES = 1024 * 1024
+
+
+def make_s3_client(max_workers=DEFAULT_WORKERS, endpoint_url=None, unsigned=True):
+    """
+    Creates the S3 client shared by all download threads (boto3 clients are thread-safe).
+    Its connection pool is sized to the number of workers so threads never wait for a
+    connection. `endpoint_url` points the client at an S3-compatible server such as MinIO.
+    """
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.client import Config
+
+    config = Config(
+        max_pool_connections=max_workers,
+        retries={'max_attempts': 5, 'mode': 'standard'},
+        signature_version=UNSIGNED if unsigned else None,
+    )
+    return boto3.client('s3', endpoint_url=endpoint_url, config=config)
+
+
+def month_range(start, end):
+    """Returns the months from `start` to `end` (inclusive) as 'YYYY-MM' strings."""
+    return list(pd.period_range(start, end, freq='M').strftime('%Y-%m'))
+
+
+class DownloadManifest:
+    """
+    Append-only record of the parts that finished downloading, keyed by (bucket, key)
+    with their ETag and size. A part is skipped on the next run when the object in S3
+    still has the same ETag and size and its local file exists.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by an interrupted run
+                    self._entries[(entry['bucket'], entry['key'])] = entry
+
+    def is_complete(self, part):
+        entry = self._entries.get((part['bucket'], part['key']))
+        return (
+            entry is not None
+            and entry['etag'] == part['etag']
+            and entry['size'] == part['size']
+            and os.path.exists(part['dest'])
+        )
+
+    def record(self, part):
+        entry = {name: part[name] for name in ('bucket', 'key', 'etag', 'size', 'dest')}
+        self._entries[(part['bucket'], part['key'])] = entry
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+
+def _sources(stations, cities, months, parameters, out_dir):
+    """Lists the (kind, bucket, prefix, destination directory) to download."""
+    sources = []
+    for year in sorted({month[:4] for month in months}):
+        for station in stations:
+            dest_dir = os.path.join(out_dir, 'noaa_gsod', f'year={year}', f'station={station}')
+            sources.append(('noaa', NOAA_BUCKET, f'{year}/{station}.csv', dest_dir))
+    for city in cities:
+        for month in months:
+            for parameter in parameters:
+                partition = os.path.join(f'city={city}', f'month={month}', f'parameter={parameter}')
+                prefix = f'{OPENAQ_PREFIX}/city={city}/month={month}/parameter={parameter}/'
+                sources.append(('openaq', OPENAQ_BUCKET, prefix, os.path.join(out_dir, 'openaq', partition)))
+    return sources
+
+
+def _list_parts(client, kind, bucket, prefix, dest_dir):
+    parts = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            if kind == 'noaa':
+                if key != prefix:
+                    continue  # e.g. '<station>.csv.bak' shares the prefix
+                dest = os.path.join(dest_dir, 'part-0.parquet')
+            else:
+                dest = os.path.join(dest_dir, os.path.basename(key))
+            parts.append({
+                'kind': kind,
+                'bucket': bucket,
+                'key': key,
+                'etag': obj['ETag'].strip('"'),
+                'size': obj['Size'],
+                'dest': dest,
+            })
+    return parts
+
+
+def _download_part(client, part):
+    """
+    Streams one object to disk and returns the number of bytes transferred.
+
+    Bytes go to a staging file named after the object's ETag. If a previous run was
+    interrupted, the download resumes with a ranged GET from the staging file's size;
+    `IfMatch` guarantees the remaining bytes belong to the same object version.
+    """
+    dest = part['dest']
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    staging = f"{dest}.{part['etag'].replace('-', '_')}.part"
+    offset = os.path.getsize(staging) if os.path.exists(staging) else 0
+    if offset > part['size']:
+        offset = 0
+
+    if offset < part['size']:
+        request = {'Bucket': part['bucket'], 'Key': part['key'], 'IfMatch': part['etag']}
+        if offset:
+            request['Range'] = f'bytes={offset}-'
+        body = client.get_object(**request)['Body']
+        with open(staging, 'ab' if offset else 'wb') as f:
+            for chunk in body.iter_chunks(_READ_CHUNK_BYTES):
+                f.write(chunk)
+    size = os.path.getsize(staging)
+    if size != part['size']:
+        raise IOError(f"s3://{part['bucket']}/{part['key']}: got {size} of {part['size']} bytes")
+
+    if part['kind'] == 'noaa':
+        # Station CSVs are small; store them as typed Parquet like the other raw inputs
+        tmp_path = f'{dest}.tmp'
+        table = pacsv.read_csv(staging, convert_options=pacsv.ConvertOptions(column_types=NOAA_TYPES))
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, dest)
+        os.remove(staging)
+    else:
+        os.replace(staging, dest)
+    return part['size'] - offset
+
+
+def download_partitions(
+    stations=DEFAULT_STATIONS,
+    cities=DEFAULT_CITIES,
+    months=DEFAULT_MONTHS,
+    parameters=DEFAULT_PARAMETERS,
+    out_dir=RAW_DIR,
+    max_workers=DEFAULT_WORKERS,
+    client=None,
+    endpoint_url=None,
+):
+    """
+    Downloads NOAA GSOD station-years and OpenAQ city/month/parameter partitions in parallel.
+
+    Args:
+        stations (list): NOAA GSOD station ids ('USAF-WBAN'); the years come from `months`.
+        cities (list): OpenAQ city names as they appear in the bucket's partitions.
+        months (tuple): Inclusive ('YYYY-MM', 'YYYY-MM') range.
+        parameters (list): OpenAQ parameters, e.g. ['pm25', 'o3'].
+        out_dir (str): Root of the local partitioned layout.
+        max_workers (int): Threads listing and downloading parts; they share one client.
+        client: An existing S3 client (e.g. one backed by moto in tests).
+        endpoint_url (str, optional): S3-compatible endpoint used when `client` is None.
+
+    Parts recorded in the manifest with the same ETag and size are skipped, and parts cut
+    short by an interrupted run are resumed. Failed parts are reported after the others
+    finish; running again picks them up.
+
+    Returns:
+        dict: Download statistics (parts, downloaded, skipped, bytes, seconds).
+    """
+    client = client if client is not None else make_s3_client(max_workers, endpoint_url)
+    sources = _sources(stations, cities, month_range(*months), parameters, out_dir)
+    manifest = DownloadManifest(os.path.join(out_dir, MANIFEST_NAME))
+    start = time.perf_counter()
+    downloaded = 0
+    transferred = 0
+    failures = []
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='s3-download') as pool:
+        listings = pool.map(lambda source: _list_parts(client, *source), sources)
+        parts = [part for listing in listings for part in listing]
+        if not parts:
+            raise FileNotFoundError("No NOAA or OpenAQ objects found for the requested stations, cities and months.")
+        pending = [part for part in parts if not manifest.is_complete(part)]
+        print(f"Found {len(parts)} parts; {len(parts) - len(pending)} already downloaded.")
+
+        futures = {pool.submit(_download_part, client, part): part for part in pending}
+        for future in as_completed(futures):
+            part = futures[future]
+            try:
+                transferred += future.result()
+            except Exception as e:
+                failures.append(part['key'])
+                print(f"  Failed s3://{part['bucket']}/{part['key']}: {e}")
+                continue
+            # The manifest is only written from this thread
+            manifest.record(part)
+            downloaded += 1
+            print(f"  [{downloaded}/{len(pending)}] {part['key']}")
+
+    seconds = time.perf_counter() - start
+    stats = {
+        'parts': len(parts),
+        'downloaded': downloaded,
+        'skipped': len(parts) - len(pending),
+        'failed': len(failures),
+        'bytes': transferred,
+        'seconds': seconds,
+    }
+    print(f"Downloaded {downloaded} parts ({transferred / 1024 / 1024:.1f} MB) in {seconds:.1f}s, "
+          f"skipped {stats['skipped']}.")
+    if failures:
+        raise RuntimeError(f"{len(failures)} part(s) failed to download; run again to resume them.")
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Download NOAA GSOD and OpenAQ partitions from S3.")
+    parser.add_argument('--stations', nargs='+', default=DEFAULT_STATIONS)
+    parser.add_argument('--cities', nargs='+', default=DEFAULT_CITIES)
+    parser.add_argument('--months', nargs=2, default=DEFAULT_MONTHS, metavar=('START', 'END'),
+                        help="inclusive month range, e.g. 2024-01 2024-06")
+    parser.add_argument('--parameters', nargs='+', default=DEFAULT_PARAMETERS)
+    parser.add_argument('--out-dir', default=RAW_DIR)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--endpoint-url', default=None, help="S3-compatible endpoint, e.g. a local MinIO")
+    args = parser.parse_args()
+    download_partitions(
+        stations=args.stations,
+        cities=args.cities,
+        months=tuple(args.months),
+        parameters=args.parameters,
+        out_dir=args.out_dir,
+        max_workers=args.workers,
+        endpoint_url=args.endpoint_url,
+    )
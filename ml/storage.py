@@ -0,0 +1,236 @@
+import json
+import os
+import shutil
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# --- Storage locations ---
+# The engineered dataset is stored three ways:
+# - a Parquet dataset partitioned by city/month, read by the training scripts with
+#   column projection and predicate pushdown;
+# - an uncompressed Arrow IPC file that the serving process memory-maps;
+# - the legacy CSV, kept as a human-readable fallback.
+DATA_DIR = 'data'
+DATASET_PATH = os.path.join(DATA_DIR, 'final_data')
+ARROW_PATH = os.path.join(DATA_DIR, 'final_data.arrow')
+CSV_PATH = os.path.join(DATA_DIR, 'final_data.csv')
+# Forecasts precomputed by `ml/forecast.py` for the backend, one row per item and day
+FORECAST_PATH = os.path.join(DATA_DIR, 'forecasts.arrow')
+DEFAULT_CITY = 'chicago'
+
+PARTITIONING = ds.partitioning(
+    pa.schema([('city', pa.string()), ('year_month', pa.string())]), flavor='hive'
+)
+
+# Column types of the engineered dataset; columns not listed here keep their inferred type
+FINAL_DATA_TYPES = {
+    'date': pa.timestamp('ms'),
+    'city': pa.string(),
+    'month': pa.int16(),
+    'day_of_year': pa.int16(),
+    'weekday': pa.int16(),
+}
+
+# Raw sample files and the columns the pipeline reads from them
+RAW_TYPES = {
+    'openaq_chicago_sample': {
+        'date.utc': pa.string(),
+        'value': pa.float64(),
+        'parameter': pa.string(),
+        'unit': pa.string(),
+        'location': pa.string(),
+        'country': pa.string(),
+        'city': pa.string(),
+    },
+    'noaa_gsod_chicago_sample': {
+        'STATION': pa.string(),
+        'DATE': pa.string(),
+        'TEMP': pa.float64(),
+        'WDSP': pa.float64(),
+        'PRCP': pa.float64(),
+    },
+}
+
+
+def _to_table(df, city=DEFAULT_CITY):
+    df = df.copy()
+    if 'city' not in df.columns:
+        df['city'] = city
+    df['date'] = pd.to_datetime(df['date'])
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    schema = pa.schema([
+        pa.field(field.name, FINAL_DATA_TYPES.get(field.name, field.type)) for field in table.schema
+    ])
+    return table.cast(schema)
+
+
+def write_final_data(df, city=DEFAULT_CITY, dataset_path=DATASET_PATH, arrow_path=ARROW_PATH):
+    """
+    Writes the engineered dataset as a city/month partitioned Parquet dataset and as a
+    memory-mappable Arrow IPC file, replacing any previous dataset (including partitions
+    the new data does not cover). Rows without a `city` column are assigned `city`.
+    """
+    table = _to_table(df, city)
+    year_month = pa.array(pd.to_datetime(df['date']).dt.strftime('%Y-%m'), pa.string())
+    # Written next to the target and swapped in, so no partition of an earlier run survives
+    tmp_path, old_path = f'{dataset_path}.tmp', f'{dataset_path}.old'
+    for path in (tmp_path, old_path):
+        shutil.rmtree(path, ignore_errors=True)
+    ds.write_dataset(
+        table.append_column('year_month', year_month),
+        tmp_path,
+        format='parquet',
+        partitioning=PARTITIONING,
+    )
+    if os.path.exists(dataset_path):
+        os.replace(dataset_path, old_path)
+    os.replace(tmp_path, dataset_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    _write_arrow(table, arrow_path)
+
+
+def append_final_data(df, city=DEFAULT_CITY, dataset_path=DATASET_PATH, arrow_path=ARROW_PATH):
+    """
+    Appends engineered rows: new Parquet files are added to the partitions (existing files
+    are left untouched) and the Arrow file is rewritten with the new rows at the end.
+    """
+    table = _to_table(df, city)
+    year_month = pa.array(pd.to_datetime(df['date']).dt.strftime('%Y-%m'), pa.string())
+    ds.write_dataset(
+        table.append_column('year_month', year_month),
+        dataset_path,
+        format='parquet',
+        partitioning=PARTITIONING,
+        basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+    )
+    if os.path.exists(arrow_path):
+        existing = read_arrow_table(arrow_path)
+        table = pa.concat_tables([existing, table.cast(existing.schema)])
+    _write_arrow(table, arrow_path)
+
+
+def _write_arrow(table, arrow_path):
+    # Uncompressed so the serving process can memory-map it without decoding. The file is
+    # written next to the target and then renamed, so readers never see a partial file.
+    tmp_path = f'{arrow_path}.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, arrow_path)
+
+
+def read_final_data(columns=None, start=None, end=None, cities=None, include_city=False, dataset_path=DATASET_PATH):
+    """
+    Reads the engineered dataset with column projection and predicate pushdown.
+
+    Args:
+        columns (list, optional): Columns to load; requested columns that do not exist
+            in the data are skipped. Defaults to every data column except `city`.
+        include_city (bool): Also load the `city` column when `columns` is not given.
+        start, end (date-like, optional): Inclusive date range. Month partitions outside
+            the range are never opened and Parquet row-group statistics prune the rest.
+        cities (list, optional): Only load these cities' partitions.
+
+    Falls back to the CSV file when the Parquet dataset has not been written yet.
+    Raises FileNotFoundError if neither exists.
+    """
+    if not os.path.exists(dataset_path):
+        return _read_final_csv(columns, start, end, cities, include_city)
+
+    dataset = ds.dataset(dataset_path, format='parquet', partitioning=PARTITIONING)
+    available = [name for name in dataset.schema.names if name != 'year_month']
+    if columns is None:
+        columns = [name for name in available if name != 'city' or include_city]
+    else:
+        columns = [name for name in columns if name in available]
+
+    table = dataset.to_table(columns=columns, filter=_build_filter(start, end, cities))
+    df = table.to_pandas()
+    return df.sort_values('date', kind='stable').reset_index(drop=True) if 'date' in df.columns else df
+
+
+def _build_filter(start, end, cities):
+    conditions = []
+    if start is not None:
+        start = pd.Timestamp(start)
+        conditions.append(ds.field('year_month') >= start.strftime('%Y-%m'))
+        conditions.append(ds.field('date') >= start.to_pydatetime())
+    if end is not None:
+        end = pd.Timestamp(end)
+        conditions.append(ds.field('year_month') <= end.strftime('%Y-%m'))
+        conditions.append(ds.field('date') <= end.to_pydatetime())
+    if cities is not None:
+        conditions.append(ds.field('city').isin([c.lower() for c in cities]))
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def _read_final_csv(columns, start, end, cities, include_city=False):
+    usecols = None
+    if columns is not None:
+        header = pd.read_csv(CSV_PATH, nrows=0).columns
+        usecols = [name for name in header if name in columns]
+    df = pd.read_csv(CSV_PATH, usecols=usecols, parse_dates=['date'] if usecols is None or 'date' in usecols else None)
+    if start is not None:
+        df = df[df['date'] >= pd.Timestamp(start)]
+    if end is not None:
+        df = df[df['date'] <= pd.Timestamp(end)]
+    if cities is not None and 'city' in df.columns:
+        df = df[df['city'].str.lower().isin([c.lower() for c in cities])]
+    if columns is None and not include_city and 'city' in df.columns:
+        df = df.drop(columns=['city'])
+    return df.reset_index(drop=True)
+
+
+def read_arrow_table(path=ARROW_PATH):
+    """Memory-maps the Arrow IPC file; the returned table references the mapped pages."""
+    source = pa.memory_map(path, 'r')
+    return pa.ipc.open_file(source).read_all()
+
+
+def write_forecast_table(df, metadata, path=FORECAST_PATH):
+    """
+    Writes precomputed forecasts as a memory-mappable Arrow IPC file. `metadata`
+    (a JSON-serializable dict) is stored in the schema under the 'forecast' key.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({'forecast': json.dumps(metadata)})
+    _write_arrow(table, path)
+
+
+def read_forecast_metadata(path=FORECAST_PATH):
+    """Returns the metadata of the forecast table, or {} if it does not exist."""
+    if not os.path.exists(path):
+        return {}
+    with pa.memory_map(path, 'r') as source:
+        schema = pa.ipc.open_file(source).schema
+    return json.loads((schema.metadata or {}).get(b'forecast', b'{}'))
+
+
+def convert_raw_to_parquet(name, data_dir=DATA_DIR):
+    """Converts a raw sample CSV (e.g. 'openaq_chicago_sample') to a typed Parquet file."""
+    csv_path = os.path.join(data_dir, f'{name}.csv')
+    parquet_path = os.path.join(data_dir, f'{name}.parquet')
+    table = pacsv.read_csv(csv_path, convert_options=pacsv.ConvertOptions(column_types=RAW_TYPES.get(name, {})))
+    pq.write_table(table, parquet_path)
+    return parquet_path
+
+
+def read_raw(name, columns=None, data_dir=DATA_DIR):
+    """Reads a raw input, preferring its Parquet copy (with column projection) over the CSV."""
+    parquet_path = os.path.join(data_dir, f'{name}.parquet')
+    if os.path.exists(parquet_path):
+        return pq.read_table(parquet_path, columns=columns).to_pandas()
+    return pd.read_csv(os.path.join(data_dir, f'{name}.csv'), usecols=columns)
+
+
+if __name__ == '__main__':
+    for raw_name in RAW_TYPES:
+        print(f"Converted {raw_name} to {convert_raw_to_parquet(raw_name)}")
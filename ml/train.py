@@ -1,46 +1,231 @@
 import pandas as pd
-from autogluon.tabular import TabularPredictor
+import numpy as np
 import os
-from ml.aqi import get_overall_aqi
+import json
+import shutil
+import time
+from ml.aqi import POLLUTANTS, compute_aqi
+from ml.storage import read_final_data, DATASET_PATH, DEFAULT_CITY
 
-def train_tabular_model():
+# --- Training settings ---
+TABULAR_MODEL_PATH = os.path.join('models', 'ag-aqi-predictor-tabular')
+TARGET = 'target_aqi'
+VALIDATION_PERIOD = 14
+TIME_LIMIT = 180
+
+# --- Deployment export settings ---
+# A model qualifies for deployment if its validation RMSE is within this relative
+# tolerance of the best model's RMSE and its single-row p99 latency fits the budget.
+DEPLOY_MODEL_PATH = os.path.join('models', 'ag-aqi-predictor-tabular-deploy')
+DEPLOY_RMSE_TOLERANCE = 0.05
+DEPLOY_P99_LATENCY_MS = 50.0
+LATENCY_TRIALS = 50
+
+# Written next to each trained model: per city, the last target date the model was
+# fit on, so backtests can tell in-sample windows from out-of-sample ones
+TRAINING_CUTOFF_FILE = 'training_cutoff.json'
+
+
+def _measure_latency_ms(predictor, row, model, trials=LATENCY_TRIALS):
+    """
+    Measures single-row prediction latency for one model (milliseconds).
+
+    The backend serves persisted models, so the model and its ancestors are kept in
+    memory while it is timed (otherwise every call would unpickle them from disk)
+    and unpersisted afterwards, so each candidate is timed under the same conditions.
+    """
+    predictor.persist_models(models=[model], with_ancestors=True)
+    try:
+        for _ in range(3):  # warm-up: native library initialisation
+            predictor.predict(row, model=model)
+        timings = []
+        for _ in range(trials):
+            start = time.perf_counter()
+            predictor.predict(row, model=model)
+            timings.append((time.perf_counter() - start) * 1000)
+    finally:
+        predictor.unpersist_models(models='all')
+    return float(np.percentile(timings, 50)), float(np.percentile(timings, 99))
+
+
+def save_training_cutoffs(model_path, cutoffs):
+    """Records the last target date per city (date-likes) that a model was fit on."""
+    os.makedirs(model_path, exist_ok=True)
+    cutoffs = {city: pd.Timestamp(date).strftime('%Y-%m-%d') for city, date in cutoffs.items()}
+    with open(os.path.join(model_path, TRAINING_CUTOFF_FILE), 'w') as f:
+        json.dump(cutoffs, f, indent=2, sort_keys=True)
+
+
+def load_training_cutoffs(model_path):
+    """The per-city training cutoffs of a model as Timestamps, or None if not recorded."""
+    try:
+        with open(os.path.join(model_path, TRAINING_CUTOFF_FILE)) as f:
+            return {city: pd.Timestamp(date) for city, date in json.load(f).items()}
+    except FileNotFoundError:
+        return None
+
+
+def _ensemble_weights(predictor, ensemble_name):
+    """Returns the base-model weights of a weighted ensemble, or {} if unavailable."""
+    try:
+        ensemble = predictor._trainer.load_model(ensemble_name)
+        return {name: float(weight) for name, weight in ensemble._get_model_weights().items()}
+    except Exception as e:
+        print(f"Could not read ensemble weights for {ensemble_name}: {e}")
+        return {}
+
+
+def export_deployment_model(predictor, validation_data,
+                            output_path=DEPLOY_MODEL_PATH,
+                            rmse_tolerance=DEPLOY_RMSE_TOLERANCE,
+                            p99_latency_ms=DEPLOY_P99_LATENCY_MS):
+    """
+    Exports an inference-optimized copy of the predictor.
+
+    The bagged models are refit into single `_FULL` models, then every model is
+    scored on the validation set and timed on single-row predictions. The fastest
+    model within `rmse_tolerance` of the best RMSE and under the p99 latency budget
+    is cloned to `output_path` with all other models removed. The accuracy/latency
+    trade-off of every candidate is recorded in `deployment.json`.
+    """
+    print("\n--- Exporting Deployment Model ---")
+    best_model = predictor.get_model_best()
+    weights = _ensemble_weights(predictor, best_model)
+    if weights:
+        print(f"Ensemble weights of {best_model}:")
+        for name, weight in sorted(weights.items(), key=lambda item: -item[1]):
+            print(f"  {name}: {weight:.3f}")
+
+    # Collapse k-fold bags into one model each (including the ensemble's members)
+    predictor.refit_full(model=best_model)
+
+    leaderboard = predictor.leaderboard(validation_data, silent=True)
+    row = validation_data.tail(1)[predictor.features()]
+    candidates = []
+    for _, entry in leaderboard.iterrows():
+        name = entry['model']
+        p50, p99 = _measure_latency_ms(predictor, row, name)
+        candidates.append({
+            'model': name,
+            'rmse': float(-entry['score_test']),
+            'p50_latency_ms': p50,
+            'p99_latency_ms': p99,
+            'ensemble_weight': weights.get(name.replace('_FULL', ''), None),
+        })
+
+    best_rmse = min(c['rmse'] for c in candidates)
+    rmse_limit = best_rmse * (1 + rmse_tolerance)
+    accurate = [c for c in candidates if c['rmse'] <= rmse_limit]
+    within_budget = [c for c in accurate if c['p99_latency_ms'] <= p99_latency_ms]
+    if within_budget:
+        chosen = min(within_budget, key=lambda c: (c['p99_latency_ms'], c['rmse']))
+    else:
+        print(f"Warning: no model within RMSE tolerance meets the {p99_latency_ms} ms p99 budget; "
+              "exporting the fastest accurate model.")
+        chosen = min(accurate, key=lambda c: (c['p99_latency_ms'], c['rmse']))
+
+    print(pd.DataFrame(candidates).sort_values('rmse').to_string(index=False))
+    print(f"Selected {chosen['model']}: RMSE {chosen['rmse']:.2f} (best {best_rmse:.2f}), "
+          f"p99 {chosen['p99_latency_ms']:.1f} ms")
+
+    # The clone keeps only the chosen model and its dependencies; the source predictor is left as-is
+    if os.path.exists(output_path):
+        shutil.rmtree(output_path)
+    predictor.clone_for_deployment(path=output_path, model=chosen['model'])
+    # The refit `_FULL` models were fit on the same rows as the source predictor
+    cutoff_path = os.path.join(predictor.path, TRAINING_CUTOFF_FILE)
+    if os.path.exists(cutoff_path):
+        shutil.copy(cutoff_path, output_path)
+
+    report = {
+        'source_model': best_model,
+        'deployed_model': chosen['model'],
+        'rmse_tolerance': rmse_tolerance,
+        'p99_latency_budget_ms': p99_latency_ms,
+        'best_rmse': best_rmse,
+        'deployed_rmse': chosen['rmse'],
+        'deployed_p99_latency_ms': chosen['p99_latency_ms'],
+        'within_latency_budget': bool(within_budget),
+        'candidates': candidates,
+    }
+    with open(os.path.join(output_path, 'deployment.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Deployment model saved to {output_path}")
+    return report
+
+def build_training_frame(df):
+    """
+    Adds the next-day AQI target to the engineered data.
+
+    Returns:
+        tuple: The rows that have a target (with `city`, `aqi`, `target_aqi` and
+        `target_date` columns) and the list of feature columns.
+    """
+    df = df.copy()
+    # Calculate the daily AQI over every available pollutant column
+    # to use as the target for the next day's prediction
+    # The data may hold several cities (long format), so the next day is taken per city
+    if 'city' not in df.columns:
+        df['city'] = DEFAULT_CITY
+    df['aqi'], _ = compute_aqi(df)
+    df[TARGET] = df.groupby('city')['aqi'].shift(-1)
+    df['target_date'] = pd.to_datetime(df['date']).groupby(df['city']).shift(-1)
+    df.dropna(subset=[TARGET], inplace=True)
+    df[TARGET] = df[TARGET].astype(int)
+
+    # Define features to use. 'date' is excluded as we use its components.
+    # Pollutants beyond PM2.5/O3 only feed the target AQI, so the served feature set is unchanged.
+    # The city only identifies the series; one model is shared by all cities.
+    excluded = ['date', 'city', 'aqi', TARGET, 'target_date'] + [p for p in POLLUTANTS if p not in ('pm25', 'o3')]
+    features = [col for col in df.columns if col not in excluded]
+    return df, features
+
+
+def train_tabular_model(df=None, model_path=TABULAR_MODEL_PATH, presets='best_quality',
+                        time_limit=TIME_LIMIT, export=True, num_cpus='auto'):
     """
     Trains a machine learning model using AutoGluon TabularPredictor on data
     with engineered features and evaluates it.
+
+    Args:
+        df (DataFrame, optional): The engineered data; read from the processed dataset
+            when not given (e.g. `ml.pipeline` passes the output of `prepare_data`).
+        model_path, presets, time_limit: Where and how the predictor is fit.
+        export (bool): Also export the inference-optimized deployment model.
+        num_cpus (int or 'auto'): CPU cores AutoGluon may use (e.g. a job's quota in
+            `ml.train_scheduler`).
+
+    Returns:
+        dict: The model path, validation RMSE, leaderboard and data sizes, or None if
+        the processed data does not exist.
     """
     print("--- Starting Tabular Model Training ---")
     
     # --- 1. Load Data ---
-    data_path = os.path.join('data', 'final_data.csv')
-    try:
-        df = pd.read_csv(data_path, parse_dates=['date'])
-    except FileNotFoundError:
-        print(f"Error: Processed data file not found at {data_path}")
-        print("Please run `python ml/prepare_data.py` first.")
-        return
+    if df is None:
+        try:
+            df = read_final_data(include_city=True)
+        except FileNotFoundError:
+            print(f"Error: Processed data not found at {DATASET_PATH}")
+            print("Please run `python -m ml.prepare_data` first.")
+            return None
 
     # --- 2. Target Variable Engineering ---
-    # Calculate the daily AQI to use as the target for the next day's prediction
-    df['aqi'], _ = zip(*df.apply(lambda row: get_overall_aqi(row['pm25'], row['o3']), axis=1))
-    df['target_aqi'] = df['aqi'].shift(-1)
-    df.dropna(subset=['target_aqi'], inplace=True)
-    df['target_aqi'] = df['target_aqi'].astype(int)
+    df, features = build_training_frame(df)
 
     # --- 3. Split Data into Training and Validation Sets ---
-    # Use the last 14 days for validation to simulate a real-world forecasting scenario
-    validation_period = 14
-    train_data = df.iloc[:-validation_period]
-    validation_data = df.iloc[-validation_period:]
+    # Use the last 14 days of each city for validation to simulate a real-world forecasting scenario
+    is_validation = df.groupby('city').cumcount(ascending=False) < VALIDATION_PERIOD
+    train_data = df[~is_validation]
+    validation_data = df[is_validation]
     
     print(f"Training data size: {len(train_data)}")
     print(f"Validation data size: {len(validation_data)}")
 
     # --- 4. Model Training with AutoGluon ---
-    model_path = os.path.join('models', 'ag-aqi-predictor-tabular') # New path for clarity
-    
-    # Define features to use. 'date' is excluded as we use its components.
-    features = [col for col in train_data.columns if col not in ['date', 'aqi', 'target_aqi']]
-    target = 'target_aqi'
+    # Imported here so the settings and helpers above can be used without loading AutoGluon
+    from autogluon.tabular import TabularPredictor
+    target = TARGET
     
     predictor = TabularPredictor(
         label=target,
@@ -49,9 +234,11 @@ def train_tabular_model():
         eval_metric='root_mean_squared_error'
     ).fit(
         train_data[features + [target]],
-        presets='best_quality',
-        time_limit=180
+        presets=presets,
+        time_limit=time_limit,
+        num_cpus=num_cpus
     )
+    save_training_cutoffs(model_path, train_data.groupby('city')['target_date'].max().to_dict())
 
     # --- 5. Evaluate Model on Validation Set ---
     print("\n--- Tabular Model Evaluation on Validation Set ---")
@@ -70,5 +257,17 @@ def train_tabular_model():
     print(f"Input features for prediction:\n{test_data[features]}")
     print(f"\nPredicted AQI for the next day: {int(prediction.iloc[0])}")
 
+    # --- 7. Export Inference-Optimized Model ---
+    if export:
+        export_deployment_model(predictor, validation_data)
+
+    return {
+        'model_path': model_path,
+        'validation_rmse': abs(float(performance['root_mean_squared_error'])),
+        'leaderboard': leaderboard,
+        'train_rows': len(train_data),
+        'validation_rows': len(validation_data),
+    }
+
 if __name__ == '__main__':
     train_tabular_model() 
\ No newline at end of file
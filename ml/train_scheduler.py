@@ -0,0 +1,194 @@
+import argparse
+import contextlib
+import itertools
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from ml.storage import DATASET_PATH, DEFAULT_CITY, read_final_data
+from ml.train import TIME_LIMIT
+
+# Models, logs and the combined leaderboard of a sweep are written under this directory:
+#   models/sweep/<city>/<config>/            the predictor of one job (with its train.log)
+#   models/sweep/leaderboard.csv             every model of every job
+#   models/sweep/summary.csv                 one row per job
+SWEEP_DIR = os.path.join('models', 'sweep')
+DEFAULT_CPUS_PER_JOB = 4
+
+# Native thread pools (BLAS, OpenMP in LightGBM/XGBoost, PyTorch) size themselves from these
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS')
+
+
+class TrainingJob:
+    """One independent fit: a city's data with one preset and time limit."""
+
+    def __init__(self, city, presets, time_limit, output_dir=SWEEP_DIR):
+        self.city = city
+        self.presets = presets
+        self.time_limit = time_limit
+        self.config = f'{presets}-{time_limit}s'
+        self.model_path = os.path.join(output_dir, city.replace(' ', '_'), self.config)
+
+    def __repr__(self):
+        return f'TrainingJob({self.city!r}, {self.config!r})'
+
+
+def available_cpus():
+    """CPU cores this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_quotas(cpus_per_job, max_jobs=None):
+    """Splits the available cores into disjoint sets of `cpus_per_job`, one per concurrent job."""
+    cpus = available_cpus()
+    cpus_per_job = max(1, min(cpus_per_job, len(cpus)))
+    quotas = [cpus[i:i + cpus_per_job] for i in range(0, len(cpus) - cpus_per_job + 1, cpus_per_job)]
+    return quotas[:max_jobs] if max_jobs else quotas
+
+
+# Number of cores of the worker process's quota (set by `_init_worker`)
+_WORKER_CPUS = None
+
+
+def _init_worker(quota_queue):
+    # Each worker process takes one core set for its lifetime, so concurrent fits never share cores
+    cpus = quota_queue.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    global _WORKER_CPUS
+    _WORKER_CPUS = len(cpus)
+
+
+def _run_job(job, data):
+    """Fits one job in a worker process. Returns its summary; failures are reported, not raised."""
+    from ml.train import train_tabular_model
+
+    os.makedirs(job.model_path, exist_ok=True)
+    start = time.perf_counter()
+    result = {'city': job.city, 'config': job.config, 'presets': job.presets, 'time_limit': job.time_limit,
+              'model_path': job.model_path, 'num_cpus': _WORKER_CPUS, 'pid': os.getpid()}
+    # Concurrent jobs would interleave their output; each one logs to its own file instead
+    with open(os.path.join(job.model_path, 'train.log'), 'w') as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            summary = train_tabular_model(data, model_path=job.model_path, presets=job.presets,
+                                          time_limit=job.time_limit, export=False,
+                                          num_cpus=_WORKER_CPUS or 'auto')
+            result.update(summary)
+        except Exception as e:
+            traceback.print_exc()
+            result['error'] = f'{type(e).__name__}: {e}'
+    result['wall_seconds'] = round(time.perf_counter() - start, 1)
+    return result
+
+
+def run_sweep(jobs, data_by_city, cpus_per_job=DEFAULT_CPUS_PER_JOB, output_dir=SWEEP_DIR):
+    """
+    Runs the jobs on a process pool, each worker pinned to its own set of `cpus_per_job`
+    cores and with the native thread pools limited to that many threads, so the nested
+    CatBoost/LightGBM threading of concurrent fits does not oversubscribe the machine.
+
+    Returns:
+        tuple: The combined leaderboard (every model of every job, with `city` and `config`
+        columns) and one summary row per job.
+    """
+    quotas = cpu_quotas(cpus_per_job, max_jobs=len(jobs))
+    threads = str(len(quotas[0]))
+    print(f"Running {len(jobs)} training jobs, {len(quotas)} at a time with {threads} cores each")
+
+    # Workers are spawned (not forked) so the thread limits apply before numpy and the
+    # model libraries are imported; they inherit the environment when they start.
+    context = multiprocessing.get_context('spawn')
+    quota_queue = context.Queue()
+    for quota in quotas:
+        quota_queue.put(quota)
+    saved_env = {name: os.environ.get(name) for name in THREAD_ENV_VARS}
+    os.environ.update({name: threads for name in THREAD_ENV_VARS})
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=len(quotas), mp_context=context,
+                                 initializer=_init_worker, initargs=(quota_queue,)) as pool:
+            futures = {pool.submit(_run_job, job, data_by_city[job.city]): job for job in jobs}
+            for future in as_completed(futures):
+                result = future.result()
+                status = f"failed ({result['error']})" if 'error' in result else \
+                    f"validation RMSE {result['validation_rmse']:.2f}"
+                print(f"[{len(results) + 1}/{len(jobs)}] {result['city']} / {result['config']}: "
+                      f"{status} in {result['wall_seconds']:.0f}s")
+                results.append(result)
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    return _combine(results, output_dir)
+
+
+def _combine(results, output_dir):
+    leaderboards, rows = [], []
+    for result in sorted(results, key=lambda r: (r['city'], r['config'])):
+        leaderboard = result.pop('leaderboard', None)
+        if leaderboard is not None and not leaderboard.empty:
+            leaderboards.append(leaderboard.assign(city=result['city'], config=result['config']))
+            result['best_model'] = leaderboard.iloc[0]['model']
+        rows.append(result)
+
+    summary = pd.DataFrame(rows)
+    leaderboard = pd.concat(leaderboards, ignore_index=True) if leaderboards else pd.DataFrame()
+    if not leaderboard.empty:
+        # Scores are higher-is-better (negated RMSE), so the best models come first per city
+        first = ['city', 'config', 'model']
+        leaderboard = leaderboard[first + [c for c in leaderboard.columns if c not in first]]
+        leaderboard = leaderboard.sort_values(['city', 'score_test'], ascending=[True, False], ignore_index=True)
+    os.makedirs(output_dir, exist_ok=True)
+    leaderboard.to_csv(os.path.join(output_dir, 'leaderboard.csv'), index=False)
+    summary.to_csv(os.path.join(output_dir, 'summary.csv'), index=False)
+    return leaderboard, summary
+
+
+def load_city_data(cities=None):
+    """The engineered data split by city (all cities in the data by default)."""
+    df = read_final_data(include_city=True, cities=cities)
+    if 'city' not in df.columns:
+        df['city'] = DEFAULT_CITY
+    return {city: group.reset_index(drop=True) for city, group in df.groupby('city', sort=True)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Train tabular models for several cities and configurations in parallel.")
+    parser.add_argument('--cities', nargs='+', help="cities to train (default: every city in the data)")
+    parser.add_argument('--presets', nargs='+', default=['best_quality'])
+    parser.add_argument('--time-limits', type=int, nargs='+', default=[TIME_LIMIT], help="seconds per fit")
+    parser.add_argument('--cpus-per-job', type=int, default=DEFAULT_CPUS_PER_JOB,
+                        help="cores (and native threads) given to each concurrent fit")
+    parser.add_argument('--output-dir', default=SWEEP_DIR)
+    args = parser.parse_args()
+
+    try:
+        city_data = load_city_data(args.cities)
+    except FileNotFoundError:
+        print(f"Error: Processed data not found at {DATASET_PATH}")
+        print("Please run `python -m ml.prepare_data` first.")
+        raise SystemExit(1)
+    if not city_data:
+        raise SystemExit(f"No data for cities {args.cities}")
+
+    sweep_jobs = [TrainingJob(city, presets, time_limit, args.output_dir)
+                  for city, presets, time_limit in itertools.product(city_data, args.presets, args.time_limits)]
+    start_time = time.perf_counter()
+    _, job_summary = run_sweep(sweep_jobs, city_data, args.cpus_per_job, args.output_dir)
+    columns = [c for c in ['city', 'config', 'best_model', 'validation_rmse', 'num_cpus', 'wall_seconds', 'error']
+               if c in job_summary.columns]
+    print(f"\n--- Sweep finished in {time.perf_counter() - start_time:.0f}s ---")
+    print(job_summary[columns].to_string(index=False))
+    print(f"\nCombined leaderboard saved to {os.path.join(args.output_dir, 'leaderboard.csv')}")
@@ -1,42 +1,66 @@
 import pandas as pd
-from autogluon.timeseries import TimeSeriesDataFrame, TimeSeriesPredictor
 import os
-from ml.aqi import get_overall_aqi
+from ml.aqi import POLLUTANTS, compute_aqi
+from ml.storage import read_final_data, DATASET_PATH
+from ml.train import save_training_cutoffs
 
-def train_timeseries_model():
+# Where the trained time series model is saved
+TIMESERIES_MODEL_PATH = os.path.join('models', 'ag-aqi-predictor-timeseries')
+VALIDATION_PERIOD = 14
+TIME_LIMIT = 180
+
+def load_aqi_series(df=None):
     """
-    Trains a time series model using AutoGluon TimeSeriesPredictor and evaluates it.
+    Builds the daily AQI series of every city as a TimeSeriesDataFrame, from `df` (the
+    engineered data) if given, else from the processed dataset.
+    Raises FileNotFoundError if the processed data does not exist.
     """
-    print("--- Starting Time Series Model Training ---")
+    # Only the city, date and pollutant columns are needed to build the AQI series
+    columns = ['date', 'city', *POLLUTANTS]
+    if df is None:
+        df = read_final_data(columns=columns)
+    else:
+        df = df[[c for c in columns if c in df.columns]].copy()
 
-    # --- 1. Load Data ---
-    data_path = os.path.join('data', 'final_data.csv')
-    try:
-        df = pd.read_csv(data_path, parse_dates=['date'])
-    except FileNotFoundError:
-        print(f"Error: Processed data file not found at {data_path}")
-        print("Please run `python ml/prepare_data.py` first.")
-        return
-
-    # --- 2. Prepare Data for Time Series Format ---
-    # Calculate the daily AQI, which will be our target
-    df['aqi'], _ = zip(*df.apply(lambda row: get_overall_aqi(row['pm25'], row['o3']), axis=1))
+    # Calculate the daily AQI over every available pollutant column, which will be our target
+    df['aqi'], _ = compute_aqi(df)
     
-    # TimeSeriesDataFrame requires a unique item_id for each time series.
-    # Since we only have one city, we'll create a constant ID.
-    df['item_id'] = 'Chicago'
+    # TimeSeriesDataFrame requires a unique item_id for each time series: one per city.
+    # Data without a city column holds only Chicago.
+    df['item_id'] = df['city'].str.title() if 'city' in df.columns else 'Chicago'
     
     # Rename 'date' to 'timestamp' as required by the library
     df.rename(columns={'date': 'timestamp'}, inplace=True)
 
     # Select columns: the item_id, the timestamp, the target, and any known future features
-    ts_df = df[['item_id', 'timestamp', 'aqi']]
+    ts_df = df[['item_id', 'timestamp', 'aqi']].sort_values(['item_id', 'timestamp'], kind='stable')
 
     # Convert to TimeSeriesDataFrame
-    data = TimeSeriesDataFrame(ts_df)
+    # (imported here so the settings above can be used without loading AutoGluon)
+    from autogluon.timeseries import TimeSeriesDataFrame
+    return TimeSeriesDataFrame(ts_df)
+
+def train_timeseries_model(df=None, model_path=TIMESERIES_MODEL_PATH, presets="best_quality",
+                           time_limit=TIME_LIMIT):
+    """
+    Trains a time series model using AutoGluon TimeSeriesPredictor and evaluates it.
+
+    `df` is the engineered data (read from the processed dataset when not given).
+    Returns a dict with the model path, validation RMSE, leaderboard and forecast table
+    path, or None if the processed data does not exist.
+    """
+    print("--- Starting Time Series Model Training ---")
+
+    # --- 1 & 2. Load Data and Prepare It in Time Series Format ---
+    try:
+        data = load_aqi_series(df)
+    except FileNotFoundError:
+        print(f"Error: Processed data not found at {DATASET_PATH}")
+        print("Please run `python -m ml.prepare_data` first.")
+        return None
 
     # --- 3. Split Data ---
-    validation_period = 14
+    validation_period = VALIDATION_PERIOD
     train_data = data.slice(None, -validation_period)
     
     print(f"Training data size: {len(train_data)}")
@@ -45,7 +69,7 @@ def train_timeseries_model():
     # --- 4. Model Training ---
     # We want to predict the next 14 days
     prediction_length = validation_period
-    model_path = os.path.join('models', 'ag-aqi-predictor-timeseries')
+    from autogluon.timeseries import TimeSeriesPredictor
 
     predictor = TimeSeriesPredictor(
         label='aqi',
@@ -54,9 +78,11 @@ def train_timeseries_model():
         eval_metric='RMSE' # Root Mean Squared Error
     ).fit(
         train_data,
-        presets="best_quality",
-        time_limit=180
+        presets=presets,
+        time_limit=time_limit
     )
+    train_end = pd.DataFrame(train_data).reset_index().groupby('item_id')['timestamp'].max()
+    save_training_cutoffs(model_path, {item_id.lower(): date for item_id, date in train_end.items()})
 
     # --- 5. Evaluate Model ---
     # The `evaluate` function scores predictions on the data that follows the training data.
@@ -75,5 +101,17 @@ def train_timeseries_model():
     print("Forecast for the next 14 days:")
     print(forecast)
 
+    # --- 7. Precompute the Forecast Table Served by the Backend ---
+    from ml.forecast import precompute_forecasts
+    forecast_path = precompute_forecasts(predictor, data, model_path=model_path, force=True)
+
+    return {
+        'model_path': model_path,
+        'validation_rmse': abs(float(performance['RMSE'])),
+        'leaderboard': leaderboard,
+        'series': int(data.num_items),
+        'forecast_path': forecast_path,
+    }
+
 if __name__ == '__main__':
     train_timeseries_model() 
\ No newline at end of file
@@ -0,0 +1,81 @@
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+from ml import prepare_data as prep
+from ml.storage import read_final_data
+
+REPO_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+RAW_NAMES = (prep.OPENAQ_NAME, prep.NOAA_NAME)
+
+
+def _raw_bytes(name):
+    with open(os.path.join(REPO_DATA, f'{name}.csv'), 'rb') as f:
+        return f.read()
+
+
+def _split(raw, rows, terminated):
+    """
+    Splits a raw CSV into a base and an appended part after its first `rows` data rows.
+    Unless `terminated`, the base's last newline starts the appended part instead.
+    """
+    lines = raw.splitlines(keepends=True)
+    cut = sum(len(line) for line in lines[:rows + 1])
+    if not terminated and raw[:cut].endswith(b'\n'):
+        cut -= 1
+    return raw[:cut], raw[cut:]
+
+
+def _write(name, data, mode='wb'):
+    with open(os.path.join('data', f'{name}.csv'), mode) as f:
+        f.write(data)
+
+
+def _outputs():
+    return pd.read_csv(prep.CSV_PATH), read_final_data()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(prep, 'APPEND_SETTLE_SECONDS', 0)
+    os.makedirs('data')
+    return tmp_path
+
+
+@pytest.fixture
+def full_rebuild(workdir):
+    for name in RAW_NAMES:
+        _write(name, _raw_bytes(name))
+    prep.prepare_data()
+    outputs = _outputs()
+    shutil.rmtree('data')
+    os.makedirs('data')
+    return outputs
+
+
+def test_sample_csvs_have_unterminated_last_line():
+    for name in RAW_NAMES:
+        assert not _raw_bytes(name).endswith(b'\n')
+
+
+@pytest.mark.parametrize('terminated', [True, False])
+@pytest.mark.parametrize('openaq_rows, noaa_rows', [(30, 30), (20, 25), (40, 20), (50, 10), (68, 34)])
+def test_incremental_matches_full_rebuild(full_rebuild, openaq_rows, noaa_rows, terminated):
+    parts = {
+        prep.OPENAQ_NAME: _split(_raw_bytes(prep.OPENAQ_NAME), openaq_rows, terminated),
+        prep.NOAA_NAME: _split(_raw_bytes(prep.NOAA_NAME), noaa_rows, terminated),
+    }
+    for name, (base, _) in parts.items():
+        _write(name, base)
+    prep.prepare_data()
+    for name, (_, appended) in parts.items():
+        _write(name, appended, mode='ab')
+    prep.prepare_data(incremental=True)
+
+    expected_csv, expected_dataset = full_rebuild
+    csv, dataset = _outputs()
+    pd.testing.assert_frame_equal(csv, expected_csv)
+    pd.testing.assert_frame_equal(dataset, expected_dataset)
@@ -0,0 +1,91 @@
+import io
+import os
+
+import pandas as pd
+import pytest
+
+from ml import s3_download
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+REPO_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+MONTHS = ('2024-01', '2024-02')
+PARAMETERS = ['pm25', 'o3']
+
+
+def _openaq_key(month, parameter):
+    return f'{s3_download.OPENAQ_PREFIX}/city=Chicago/month={month}/parameter={parameter}/part-0.parquet'
+
+
+def _openaq_part(seed):
+    buffer = io.BytesIO()
+    pd.DataFrame({'value': [float(seed + i) for i in range(5000)]}).to_parquet(buffer)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def s3():
+    """A moto S3 stand-in holding one NOAA station-year and four OpenAQ partitions."""
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=s3_download.NOAA_BUCKET)
+        client.create_bucket(Bucket=s3_download.OPENAQ_BUCKET)
+        with open(os.path.join(REPO_DATA, 'noaa_gsod_chicago_sample.csv'), 'rb') as f:
+            client.put_object(Bucket=s3_download.NOAA_BUCKET, Key='2024/725300-94846.csv', Body=f.read())
+        objects = {}
+        for seed, (month, parameter) in enumerate((m, p) for m in MONTHS for p in PARAMETERS):
+            objects[_openaq_key(month, parameter)] = _openaq_part(seed)
+            client.put_object(Bucket=s3_download.OPENAQ_BUCKET, Key=_openaq_key(month, parameter),
+                              Body=objects[_openaq_key(month, parameter)])
+        yield client, objects
+
+
+def _download(client, out_dir):
+    return s3_download.download_partitions(months=MONTHS, parameters=PARAMETERS, out_dir=str(out_dir),
+                                           max_workers=4, client=client)
+
+
+def _local_path(out_dir, month, parameter):
+    return os.path.join(out_dir, 'openaq', 'city=Chicago', f'month={month}', f'parameter={parameter}', 'part-0.parquet')
+
+
+def test_downloads_every_part(s3, tmp_path):
+    client, objects = s3
+    stats = _download(client, tmp_path)
+
+    assert (stats['parts'], stats['downloaded'], stats['skipped'], stats['failed']) == (5, 5, 0, 0)
+    for month in MONTHS:
+        for parameter in PARAMETERS:
+            with open(_local_path(tmp_path, month, parameter), 'rb') as f:
+                assert f.read() == objects[_openaq_key(month, parameter)]
+    noaa = pd.read_parquet(os.path.join(tmp_path, 'noaa_gsod', 'year=2024', 'station=725300-94846', 'part-0.parquet'))
+    assert len(noaa) == len(pd.read_csv(os.path.join(REPO_DATA, 'noaa_gsod_chicago_sample.csv')))
+
+
+def test_rerun_skips_parts_with_unchanged_etag(s3, tmp_path):
+    client, _ = s3
+    _download(client, tmp_path)
+    stats = _download(client, tmp_path)
+
+    assert (stats['parts'], stats['downloaded'], stats['skipped'], stats['bytes']) == (5, 0, 5, 0)
+
+
+def test_resumes_truncated_staging_file(s3, tmp_path):
+    client, objects = s3
+    _download(client, tmp_path)
+    key = _openaq_key('2024-01', 'pm25')
+    dest = _local_path(tmp_path, '2024-01', 'pm25')
+    etag = client.head_object(Bucket=s3_download.OPENAQ_BUCKET, Key=key)['ETag'].strip('"')
+    data = objects[key]
+
+    # As if the run had been interrupted halfway through this part
+    os.remove(dest)
+    with open(f"{dest}.{etag.replace('-', '_')}.part", 'wb') as f:
+        f.write(data[:len(data) // 2])
+    stats = _download(client, tmp_path)
+
+    assert (stats['downloaded'], stats['skipped'], stats['bytes']) == (1, 4, len(data) - len(data) // 2)
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(f"{dest}.{etag.replace('-', '_')}.part")